@@ -1,22 +1,31 @@
 import streamlit as st
-import vertexai
+import logging
 import os
-from datetime import datetime
 from dotenv import load_dotenv
 import tempfile
 import pymupdf
-from get_access_token import get_access_token
 from llm_manager import (
-    create_client,
     summarize_cim,
     format_summary_as_markdown,
     create_memo,
+    plan_request,
+    template_sections,
+    SectionGenerationError,
 )
-from document_manager import render_files, display_download_buttons
 from chatbots import editor_chabot, qa_chatbot
-from utils import render_markdown, upload_gcs_and_save
-from document_manager import render_files, display_download_buttons, convert_docx_to_pdf
+from utils import render_markdown, render_summary_markdown, ingest_files
+from document_manager import render_files, display_download_buttons, save_memo_as_pdf
 from memo_formatter import format_and_export_memo, fetch_headers
+from pipeline import Pipeline
+from preflight import MAX_PARALLEL_SECTIONS, describe_plan
+from pdf_optimizer import slimming_enabled, slimming_options
+from pdf_worker import run_pdf_work
+from resources import (
+    init_vertexai,
+    warm_clients,
+    get_client,
+    get_markdown_client,
+)
 
 # Set configuration and title
 st.set_page_config(layout="wide")
@@ -28,13 +37,105 @@ location = os.getenv("LOCATION")
 bucket_name = os.getenv("BUCKET_NAME")
 service_account = os.getenv("SERVICE_ACCOUNT")
 
-# Initialize Vertex AI
-vertexai.init(project=project_id, location=location)
+# Models offered for generation, and the model formatting summaries as markdown
+MODEL_OPTIONS = ("gemini-2.0-flash", "gemini-1.5-pro", "Secure GPT")
+MARKDOWN_MODEL = "gemini-1.5-flash"
+
+# Seconds between checks of the background memo pipeline
+MEMO_POLL_SECONDS = 2
+
+# Initialize Vertex AI and create the model clients once per process
+init_vertexai(project_id, location)
+warm_clients(MODEL_OPTIONS, MARKDOWN_MODEL)
+
+
+def add_memo_stages(pipeline: Pipeline, memo_client, files: dict, by_section: bool):
+    """
+    This function adds the memo chain to a pipeline: the memo text, its docx file and its PDF.
+    The memo text of the session is reused if only the export failed.
+    Args:
+        pipeline (Pipeline): The pipeline to add the stages to.
+        memo_client: The model client generating the memo.
+        files (dict): The session files.
+        by_section (bool): Whether the memo headings may be generated in parallel.
+    """
+    # Read the headings and subheadings as lists for formatting the memo
+    headings = fetch_headers("memo_elements/headings.txt")
+    subheadings = fetch_headers("memo_elements/subheadings.txt")
+    memo_text = st.session_state.memo_text
+
+    # Pick the memo strategy, unless the memo was already generated
+    memo_plan = None
+    if not memo_text:
+        memo_plan = plan_request(
+            memo_client,
+            files,
+            "memo",
+            documents_only=True,
+            section_count=len(headings),
+            allow_sections=by_section,
+        )
+        request_plans = st.session_state.setdefault("request_plans", [])
+        st.session_state.request_plans = [
+            plan for plan in request_plans if plan["task"] != "memo"
+        ] + [memo_plan]
+
+    # Generate a memo draft using the selected model
+    pipeline.add_stage(
+        "memo_text",
+        lambda: memo_text
+        or create_memo(
+            model=memo_client,
+            files=files,
+            headings=headings,
+            subheadings=subheadings,
+            strategy=memo_plan["strategy"],
+        ),
+    )
+
+    # Format memo and export to a docx file
+    pipeline.add_stage(
+        "memo_filename",
+        lambda text: format_and_export_memo(
+            filename="memo_draft.docx", memo_text=text
+        ),
+        depends_on=["memo_text"],
+    )
+
+    # Render the memo as a PDF file
+    pipeline.add_stage(
+        "memo_pdf",
+        lambda text, docx_path: save_memo_as_pdf(
+            memo_text=text,
+            output_pdf_filename="memo.pdf",
+            heading_titles=headings,
+            subheading_titles=subheadings,
+            docx_path=docx_path,
+        ),
+        depends_on=["memo_text", "memo_filename"],
+    )
+
 
-# Get access token for SecureGPT
-token_url = "https://api.veolia.com/security/v2/oauth/token"
-api_url = "https://api.veolia.com/llm/veoliasecuregpt/v1/answer"
-access_token = get_access_token(token_url, api_url)
+def regenerate_memo():
+    """
+    This function clears the memo error, so the memo chain is scheduled again on the rerun.
+    """
+    st.session_state.pop("memo_error", None)
+    st.session_state.regenerate_memo = True
+
+
+@st.fragment(run_every=MEMO_POLL_SECONDS)
+def poll_memo():
+    """
+    This function shows the memo progress and reruns the app once the memo pipeline has finished,
+    so the memo is collected without the user refreshing.
+    """
+    pipeline = st.session_state.get("memo_pipeline")
+    if pipeline is None:
+        return
+    if pipeline.done():
+        st.rerun()
+    st.caption("Generating memo draft...")
 
 
 # ----------------- #
@@ -55,7 +156,6 @@ if "files" not in st.session_state:
 # Initialize session state variables
 if "temp_dir" not in st.session_state:
     st.session_state.temp_dir = tempfile.mkdtemp()
-st.session_state.markdown_gemini_client = create_client(model_name="gemini-1.5-flash")
 if "memo_filename" not in st.session_state:
     st.session_state.memo_filename = None
 if "memo_text" not in st.session_state:
@@ -75,11 +175,20 @@ with tab1:
     # Model selection
     model_option = st.selectbox(
         label="Choose a model to generate a summary:",
-        options=("gemini-2.0-flash", "gemini-1.5-pro", "Secure GPT"),
+        options=MODEL_OPTIONS,
         index=None,
         placeholder="Select a model...",
     )
 
+    # Allow generating each section of the template with its own request
+    by_section = st.checkbox(
+        "Generate sections in parallel",
+        value=False,
+        help="Faster for long templates, but every section resends the documents. "
+        "A failed section is retried on its own. Used when the template has at most "
+        f"{MAX_PARALLEL_SECTIONS} sections and the estimated input tokens of the documents allow it.",
+    )
+
     # File upload for CIM template outline
     uploaded_template = st.file_uploader(
         "Upload your CIM template:", type=["pdf", "txt"], accept_multiple_files=True
@@ -90,10 +199,28 @@ with tab1:
         "Upload your files:", type=["pdf", "txt"], accept_multiple_files=True
     )
 
+    # Optimize the PDFs before upload, optionally dropping pages such as legal boilerplate
+    slim_pdfs = st.checkbox(
+        "Optimize PDFs before upload",
+        value=slimming_enabled(),
+        help="Downsamples high-resolution images and compresses the files, so large CIMs upload and process faster.",
+    )
+    exclude_pages = st.text_input(
+        "Pages to exclude from the documents:",
+        placeholder="e.g. 1-2, 140-150",
+        disabled=not slim_pdfs,
+        help="Excluded pages are replaced with blank pages, so the other pages keep their page numbers.",
+    )
+
     # Save model option for LLM
     if model_option:
         st.session_state.model_option = model_option
 
+    # Format summaries with a model of the selected model's provider
+    st.session_state.markdown_client = get_markdown_client(
+        MARKDOWN_MODEL, st.session_state.get("model_option")
+    )
+
     if (
         len(uploaded_template) > 0
         and len(uploaded_files) > 0
@@ -101,90 +228,113 @@ with tab1:
     ):
         # Load and upload files to GCS
         with st.spinner("Processing files..."):
-            # Create a timestamp for the files
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            # Upload the information documents and templates to GCS in parallel and save to session
+            paths = ingest_files(
+                bucket_name,
+                [(file, "document") for file in uploaded_files]
+                + [(file, "template") for file in uploaded_template],
+                slim_options=slimming_options() if slim_pdfs else None,
+                exclude_pages=exclude_pages,
+            )
 
-            # Upload the information documents to GCS and save to session
-            for file in uploaded_files:
-                path = upload_gcs_and_save(bucket_name, file, "document")
+        st.toast("Files processed succesfully!", icon="🎉")
 
-            # Upload the template to GCS and save to session
-            for file in uploaded_template:
-                path = upload_gcs_and_save(bucket_name, file, "template")
+        # Report the bytes saved by the PDF optimization
+        slim_reports = [
+            file_info["slim_report"]
+            for file_info in st.session_state.files.values()
+            if file_info.get("slim_report")
+        ]
+        if slim_reports:
+            original_bytes = sum(report["original_bytes"] for report in slim_reports)
+            slimmed_bytes = sum(report["slimmed_bytes"] for report in slim_reports)
+            st.toast(
+                f"Optimized PDFs from {original_bytes / 1e6:.1f} MB to {slimmed_bytes / 1e6:.1f} MB",
+                icon="📉",
+            )
+
+    # Generate CIM summary and memo, unless the last attempt failed and was not retried
+    if (
+        len(st.session_state.files) > 1
+        and "summary" not in st.session_state
+        and "summary_error" not in st.session_state
+        and model_option
+    ):
+        # Create clients routed from the selected model, Gemini or Secure GPT
+        llm_client = get_client(model_name=st.session_state.model_option, task="summary")
+        memo_client = get_client(model_name=st.session_state.model_option, task="memo")
+
+        # Capture session values for the pipeline stages
+        files = st.session_state.files
+        markdown_client = st.session_state.markdown_client
+        completed_sections = st.session_state.get("summary_sections")
+
+        # Estimate the input tokens and pick the summary strategy before sending anything
+        with st.spinner("Estimating input tokens..."):
+            summary_plan = plan_request(
+                llm_client,
+                files,
+                "summary",
+                section_count=len(template_sections(files)),
+                allow_sections=by_section,
+            )
+        st.session_state.request_plans = [summary_plan]
+
+        # Schedule the summary and memo chains to run in parallel
+        pipeline = Pipeline()
+        pipeline.add_stage(
+            "summary",
+            lambda: summarize_cim(
+                model=llm_client,
+                files=files,
+                structured=True,
+                strategy=summary_plan["strategy"],
+                completed_sections=completed_sections,
+            ),
+        )
 
-        st.toast("Files processed succesfully!", icon="🎉")
+        # Render the structured summary as markdown tables locally
+        pipeline.add_stage(
+            "display_summary",
+            lambda summary: render_summary_markdown(summary)
+            or format_summary_as_markdown(
+                model=markdown_client, summary=summary
+            ),
+            depends_on=["summary"],
+        )
 
-        # Generate CIM summary and memo
+        # Format the memo according to memo outline, unless it is still being generated or failed
         if (
-            len(st.session_state.files) > 1
-            and "summary" not in st.session_state
-            and model_option
+            st.session_state.memo_filename is None
+            and "memo_pipeline" not in st.session_state
+            and "memo_error" not in st.session_state
         ):
-            with st.spinner("Generating summary..."):
-                # Generate summary using Gemini
-                if model_option.startswith("gemini"):
-                    # Create a client
-                    gemini_client = create_client(
-                        model_name=st.session_state.model_option
-                    )
-
-                    # Generate a summary using the uploaded files
-                    summary_from_gemini = summarize_cim(
-                        model=gemini_client, files=st.session_state.files
-                    )
-
-                    # Format the summary as markdown
-                    display_summary = format_summary_as_markdown(
-                        model=st.session_state.markdown_gemini_client,
-                        summary=summary_from_gemini,
-                    )
-
-                    # Save both summaries to the session state
-                    st.session_state.summary = summary_from_gemini
-                    st.session_state.display_summary = display_summary
-
-                    # Generate a memo draft
-                    if st.session_state.memo_text is None:
-                        # Read the headings and subheadings as lists for formatting the memo
-                        headings = fetch_headers("memo_elements/headings.txt")
-                        subheadings = fetch_headers("memo_elements/subheadings.txt")
-
-                        # Generate the memo using Gemini
-                        memo_text = create_memo(
-                            model=gemini_client,
-                            files=st.session_state.files,
-                            headings=headings,
-                            subheadings=subheadings,
-                        )
-                        st.session_state.memo_text = memo_text
-
-                    # Format the memo according to memo outline
-                    if st.session_state.memo_filename is None:
-                        # Format memo and export to a docx file
-                        memo_filename = "memo_draft.docx"
-                        st.session_state.memo_filename = format_and_export_memo(
-                            filename=memo_filename
-                        )
-
-                        # Convert the memo to a PDF file
-                        try:
-                            pdf_filename = "memo.pdf"
-                            memo_output_path, memo_filename = convert_docx_to_pdf(
-                                docx_path=st.session_state.memo_filename,
-                                output_pdf_filename=pdf_filename,
-                            )
-
-                            # Save the rendered memo to the session state
-                            st.session_state.files["Memo"] = {
-                                "doc": pymupdf.open(memo_output_path)
-                            }
-                        except Exception as e:
-                            st.error(
-                                f"Error converting memo to PDF: {e}. Please try again."
-                            )
-
-                elif model_option == "Secure GPT":
-                    st.session_state.summary = "Secure GPT not implemented yet. "
+            add_memo_stages(pipeline, memo_client, files, by_section)
+
+        pipeline.run()
+        if "memo_text" in pipeline.stages:
+            st.session_state.memo_pipeline = pipeline
+
+        # Wait only for the summary, the memo finishes in the background
+        with st.spinner("Generating summary..."):
+            try:
+                # Save the structured summary and its rendered markdown to the session state
+                st.session_state.display_summary = pipeline.result(
+                    "display_summary"
+                )
+                st.session_state.summary = pipeline.result("summary")
+                st.session_state.pop("summary_sections", None)
+            except Exception as e:
+                # Keep the error, so the summary is not generated again until the user asks
+                logging.exception("Summary generation failed")
+                st.session_state.summary_error = str(e)
+                # Keep the sections generated in parallel, so a retry only generates the failed ones
+                if isinstance(e, SectionGenerationError):
+                    st.session_state.summary_sections = e.completed
+
+    # Display the estimated input tokens and the chosen strategies
+    for request_plan in st.session_state.get("request_plans", []):
+        st.caption(f"{request_plan['task'].capitalize()}: {describe_plan(request_plan)}")
 
     #  Display markdown summary
     if "display_summary" in st.session_state:
@@ -199,9 +349,70 @@ with tab1:
         # Display download buttons for the summary
         display_download_buttons(summary_name="summary")
 
+    elif "summary_error" in st.session_state:
+        st.error(
+            f"Error generating summary: {st.session_state.summary_error}. Please try again."
+        )
+        # Clear the error, so the summary is generated again on the rerun
+        st.button(
+            "Regenerate summary",
+            key="summary_regenerate",
+            on_click=st.session_state.pop,
+            args=("summary_error", None),
+        )
+
     else:
         st.write("Please upload at least two files and choose a model.")
 
+    # Schedule only the memo chain again after a failure
+    if (
+        model_option
+        and "memo_pipeline" not in st.session_state
+        and st.session_state.pop("regenerate_memo", False)
+    ):
+        pipeline = Pipeline()
+        add_memo_stages(
+            pipeline,
+            get_client(model_name=st.session_state.model_option, task="memo"),
+            st.session_state.files,
+            by_section,
+        )
+        pipeline.run()
+        st.session_state.memo_pipeline = pipeline
+
+    # Collect the memo draft from the background pipeline once it has finished
+    if "memo_pipeline" in st.session_state:
+        pipeline = st.session_state.memo_pipeline
+        if not pipeline.done():
+            # Poll until the memo is ready, then rerun to collect it
+            poll_memo()
+        else:
+            try:
+                st.session_state.memo_text = pipeline.result("memo_text")
+                st.session_state.memo_filename = pipeline.result("memo_filename")
+
+                # Save the rendered memo to the session state
+                try:
+                    memo_output_path, _ = pipeline.result("memo_pdf")
+                    st.session_state.files["Memo"] = {
+                        "doc": run_pdf_work(pymupdf.open, memo_output_path)
+                    }
+                except Exception as e:
+                    st.error(f"Error converting memo to PDF: {e}. Please try again.")
+            except Exception as e:
+                # Keep the error, so the memo is not generated again until the user asks
+                logging.exception("Memo generation failed")
+                st.session_state.memo_error = str(e)
+            finally:
+                # Drop the finished pipeline, so a failure is not raised again on every rerun
+                del st.session_state.memo_pipeline
+                pipeline.shutdown()
+
+    # Report a failed memo and offer to generate it again
+    if "memo_error" in st.session_state:
+        st.error(f"Error generating memo draft: {st.session_state.memo_error}. Please try again.")
+        st.button("Regenerate memo", key="memo_regenerate", on_click=regenerate_memo)
+
     # Display download memo draft button
     if st.session_state.memo_filename:
         st.divider()
@@ -1,9 +1,46 @@
 import streamlit as st
-from llm_manager import create_client, chat_with_model, format_summary_as_markdown
+from llm_manager import (
+    create_cached_client,
+    chat_with_model,
+    format_summary_as_markdown,
+    plan_request,
+)
 from document_manager import display_download_buttons
-from utils import render_markdown
+from utils import render_markdown, render_summary_markdown
+from retrieval import format_retrieved_pages
+from preflight import RETRIEVAL, describe_plan
+from resources import get_client
+from response_cache import files_content_hashes
 
+# Number of pages retrieved for each Q&A question
+QA_RETRIEVAL_PAGES = 8
 
+
+def stream_to_placeholder(chunks, placeholder, render=None) -> str:
+    """
+    This function renders a streamed model response into a placeholder as it arrives.
+    Args:
+        chunks (Iterator[str]): The text chunks of the response.
+        placeholder (st.empty): The placeholder to render the response in.
+        render (Callable, optional): Converts the partial response to markdown. Returns None if it cannot be rendered yet.
+    Returns:
+        str: The full text of the response.
+    """
+    response = ""
+    for chunk in chunks:
+        response += chunk
+        display_response = render(response) if render else response
+        if display_response:
+            placeholder.markdown(
+                render_markdown(display_response) + " ▌", unsafe_allow_html=True
+            )
+
+    if not render:
+        placeholder.markdown(render_markdown(response), unsafe_allow_html=True)
+    return response
+
+
+@st.fragment
 def editor_chabot():
     """
     This function displays the editor chatbot interface in Streamlit.
@@ -11,6 +48,7 @@ def editor_chabot():
     Users may ask the bot to refine the summary by making requested edits.
     Chat history and updated summaries are displayed in the interface.
     Users have the options to download the latest edited summary and clear the chat history.
+    Runs as a fragment, so chat turns only rerun the chatbot.
     """
 
     # Initialize session state variables
@@ -22,12 +60,13 @@ def editor_chabot():
 
     if "latest_editor_chatbot_response" not in st.session_state:
         st.session_state.latest_editor_chatbot_response = None
+        st.session_state.latest_editor_display_response = None
 
     if "editor_messages" not in st.session_state:
         st.session_state.editor_messages = [st.session_state.editor_intro_msg]
 
     # Init model for editor chatbot
-    editor_chat_client = create_client(
+    editor_chat_client = get_client(
         st.session_state.model_option, chatbot_function="editor"
     )
 
@@ -68,49 +107,71 @@ def editor_chabot():
                 st.write(prompt)
 
         with editor_chat_placeholder:
-            with st.spinner("Generating response..."):
-                # Send request to the editor chatbot
-                editor_response = chat_with_model(
-                    model=editor_chat_client,
+            with st.chat_message("assistant"):
+                response_placeholder = st.empty()
+
+                # Reuse the cached file context when available
+                editor_cached_client = create_cached_client(
+                    st.session_state.model_option,
                     files=st.session_state.files,
-                    summary=st.session_state.summary,
-                    user_prompt=prompt,
-                    msg_history=st.session_state.editor_messages,
-                    documents_only=False,
+                    chatbot_function="editor",
+                    fallback=editor_chat_client,
                 )
 
-                # Format the response for display in the chat
-                editor_display_response = format_summary_as_markdown(
-                    st.session_state.markdown_gemini_client, summary=editor_response
+                # Stream the structured response from the editor chatbot as markdown tables
+                editor_structured_response = stream_to_placeholder(
+                    chat_with_model(
+                        model=editor_cached_client or editor_chat_client,
+                        files=st.session_state.files,
+                        summary=st.session_state.summary,
+                        user_prompt=prompt,
+                        msg_history=st.session_state.editor_messages,
+                        documents_only=False,
+                        stream=True,
+                        files_cached=editor_cached_client is not None,
+                        structured=True,
+                    ),
+                    response_placeholder,
+                    render=lambda text: render_summary_markdown(text, partial=True),
                 )
 
-            # Display the response in the chat
-            with st.chat_message("assistant"):
-                st.markdown(
+                # Render the final response, formatting it with the model if it is not valid JSON
+                editor_response = render_summary_markdown(editor_structured_response)
+                if editor_response is None:
+                    with st.spinner("Formatting response..."):
+                        editor_response = format_summary_as_markdown(
+                            st.session_state.markdown_client,
+                            summary=editor_structured_response,
+                        )
+                editor_display_response = editor_response
+
+                response_placeholder.markdown(
                     render_markdown(editor_display_response),
                     unsafe_allow_html=True,
                 )
 
-            # Save the response to the chat history
+            # Save the structured response to the chat history, so later turns edit the structured summary
             st.session_state["editor_messages"].append(
                 {
                     "role": "assistant",
-                    "content": editor_response,
+                    "content": editor_structured_response,
                     "display_response": editor_display_response,
                 }
             )
 
             # Save the latest response for edited summary download
-            st.session_state.latest_editor_chatbot_response = editor_response
+            st.session_state.latest_editor_chatbot_response = editor_structured_response
+            st.session_state.latest_editor_display_response = editor_display_response
 
-            # Rerun the session to update the chat history
-            st.rerun()
+            # Rerun the chatbot to update the chat history
+            st.rerun(scope="fragment")
 
     # Clear chat history and reset intro message
     if st.button("Clear chat history", key="clear_editor_chat_history"):
         st.session_state["editor_messages"] = [st.session_state.editor_intro_msg]
         st.session_state.latest_editor_chatbot_response = None
-        st.rerun()
+        st.session_state.latest_editor_display_response = None
+        st.rerun(scope="fragment")
 
     st.divider()
 
@@ -122,11 +183,13 @@ def editor_chabot():
 # -------------------------------------------------
 
 
+@st.fragment
 def qa_chatbot():
     """
     This function displays the Q&A chatbot interface in Streamlit.
     The chatbot reads the session files and allows users to ask questions about the documents.
     Chat history and responses are displayed in the interface.
+    Runs as a fragment, so chat turns only rerun the chatbot.
     """
 
     # Initialize session state variables
@@ -139,7 +202,7 @@ def qa_chatbot():
         st.session_state.qa_messages = [st.session_state.qa_intro_msg]
 
     # Init model for Q&A chatbot
-    qa_chat_client = create_client(st.session_state.model_option, chatbot_function="qa")
+    qa_chat_client = get_client(st.session_state.model_option, chatbot_function="qa")
 
     qa_chat_placeholder = st.container()
 
@@ -157,6 +220,30 @@ def qa_chatbot():
                 with st.chat_message(message["role"]):
                     st.write(message["content"])
 
+    # Estimate the input tokens of the documents once per set of files and model,
+    # to choose retrieval for long documents
+    qa_plan_key = (
+        st.session_state.model_option,
+        tuple(files_content_hashes(st.session_state.files)),
+    )
+    if st.session_state.get("qa_plan_key") != qa_plan_key:
+        st.session_state.qa_plan = plan_request(
+            qa_chat_client, st.session_state.files, "qa", documents_only=True
+        )
+        st.session_state.qa_plan_key = qa_plan_key
+        # Reset the toggle to the strategy of the new plan
+        st.session_state.qa_retrieval_mode = (
+            st.session_state.qa_plan["strategy"] == RETRIEVAL
+        )
+
+    # Choose between answering from the most relevant pages and the full documents
+    retrieval_mode = st.toggle(
+        "Answer from the most relevant pages only",
+        key="qa_retrieval_mode",
+        help="Faster and cheaper for long documents. Turn off to send the full documents.",
+    )
+    st.caption(describe_plan(st.session_state.qa_plan))
+
     # User chat input
     if prompt := st.chat_input("Enter your question:"):
         st.session_state["qa_messages"].append({"role": "user", "content": prompt})
@@ -167,21 +254,40 @@ def qa_chatbot():
                 st.write(prompt)
 
         with qa_chat_placeholder:
-            # Generate response
-            with st.spinner("Generating response..."):
-                qa_response = chat_with_model(
-                    model=qa_chat_client,
+            # Retrieve the most relevant pages instead of sending the full documents
+            context_pages = None
+            if retrieval_mode and "page_index" in st.session_state:
+                retrieved_pages = st.session_state.page_index.search(
+                    prompt, k=QA_RETRIEVAL_PAGES
+                )
+                if retrieved_pages:
+                    context_pages = format_retrieved_pages(retrieved_pages)
+
+            # Reuse the cached file context when available
+            qa_cached_client = None
+            if context_pages is None:
+                qa_cached_client = create_cached_client(
+                    st.session_state.model_option,
                     files=st.session_state.files,
-                    user_prompt=prompt,
-                    msg_history=st.session_state.qa_messages,
+                    chatbot_function="qa",
                     documents_only=True,
+                    fallback=qa_chat_client,
                 )
 
-            # Display the response in the chat
+            # Stream the response into the chat as it is generated
             with st.chat_message("assistant"):
-                st.markdown(
-                    render_markdown(qa_response),
-                    unsafe_allow_html=True,
+                qa_response = stream_to_placeholder(
+                    chat_with_model(
+                        model=qa_cached_client or qa_chat_client,
+                        files=st.session_state.files,
+                        user_prompt=prompt,
+                        msg_history=st.session_state.qa_messages,
+                        documents_only=True,
+                        stream=True,
+                        files_cached=qa_cached_client is not None,
+                        context_pages=context_pages,
+                    ),
+                    st.empty(),
                 )
 
             # Save the response to the chat history
@@ -192,10 +298,10 @@ def qa_chatbot():
                 }
             )
 
-            # Rerun the session to update the chat history
-            st.rerun()
+            # Rerun the chatbot to update the chat history
+            st.rerun(scope="fragment")
 
     # Clear chat history and reset intro message
     if st.button("Clear chat history", key="clear_qa_chat_history"):
         st.session_state["qa_messages"] = [st.session_state.qa_intro_msg]
-        st.rerun()
+        st.rerun(scope="fragment")
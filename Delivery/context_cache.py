@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Tuple
+
+
+def create_vertex_cached_content(
+    model_name: str, system_instruction: str, contents: list, ttl: timedelta
+):
+    """
+    This function creates a Vertex AI cached context holding the given contents.
+    Args:
+        model_name (str): The name of the model the cache is created for.
+        system_instruction (str): The system instructions stored with the cache.
+        contents (list): The Part objects to cache.
+        ttl (timedelta): How long the cache lives.
+    Returns:
+        A CachedContent object.
+    """
+    from vertexai.preview import caching
+
+    return caching.CachedContent.create(
+        model_name=model_name,
+        system_instruction=system_instruction,
+        contents=contents,
+        ttl=ttl,
+    )
+
+
+def model_from_vertex_cached_content(cached_content):
+    """
+    This function creates a GenerativeModel that reads its context from a cache.
+    Args:
+        cached_content (CachedContent): The cached context.
+    Returns:
+        A GenerativeModel object.
+    """
+    from vertexai.preview.generative_models import GenerativeModel
+
+    return GenerativeModel.from_cached_content(cached_content=cached_content)
+
+
+class ContextCacheUnavailable(Exception):
+    """
+    Raised while a context that recently failed to be created is not retried yet.
+    """
+
+
+class ContextCache:
+    """
+    A process-wide cache of model contexts holding the uploaded files.
+    One cached context is created per (model, system instruction, file set, parts mode)
+    and reused for every chat turn. Entries are refreshed before their TTL runs out while in use
+    and evicted once expired. Remote calls only hold the lock of their own file set,
+    and failed creations are not retried until the failure backoff has passed.
+    The factories can be replaced with local stand-ins.
+    """
+
+    def __init__(
+        self,
+        ttl: timedelta = timedelta(minutes=30),
+        refresh_margin: timedelta = timedelta(minutes=5),
+        failure_backoff: timedelta = timedelta(minutes=5),
+        create_cached_content: Callable = create_vertex_cached_content,
+        model_from_cached_content: Callable = model_from_vertex_cached_content,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            ttl (timedelta, optional): How long a cached context lives. Defaults to 30 minutes.
+            refresh_margin (timedelta, optional): Extend the TTL when a context is used this close to expiring.
+            failure_backoff (timedelta, optional): How long to wait before retrying a failed creation.
+            create_cached_content (Callable, optional): Factory creating a cached context.
+            model_from_cached_content (Callable, optional): Factory creating a model bound to a cached context.
+            clock (Callable, optional): Returns the current time in seconds.
+        """
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.failure_backoff = failure_backoff
+        self.create_cached_content = create_cached_content
+        self.model_from_cached_content = model_from_cached_content
+        self.clock = clock
+        self.entries: Dict[Tuple, dict] = {}
+        self.failures: Dict[Tuple, float] = {}  # Time after which a failed creation is retried
+        self._key_locks: Dict[Tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name: str, system_instruction: str, file_uris, parts_mode: str = "pdf"):
+        """
+        This function builds the cache key for a model, system instruction, file set and parts mode.
+        Returns:
+            tuple: The cache key. The order of the files does not matter.
+        """
+        return (model_name, system_instruction or "", tuple(sorted(file_uris)), parts_mode)
+
+    def get_model(
+        self,
+        model_name: str,
+        system_instruction: str,
+        file_uris,
+        contents_factory: Callable,
+        parts_mode: str = "pdf",
+    ):
+        """
+        This function returns a model bound to the cached context for the file set.
+        The context is created on first use, extended when close to expiring, and
+        recreated once expired.
+        Args:
+            model_name (str): The name of the model.
+            system_instruction (str): The system instructions for the model.
+            file_uris (Iterable[str]): The URIs of the files in the context.
+            contents_factory (Callable): Returns the Part objects to cache. Only called on a miss.
+            parts_mode (str, optional): How the files are sent, "hybrid" for extracted text plus
+                PDF excerpts or "pdf" for the whole files. Defaults to "pdf".
+        Returns:
+            A model object reading its context from the cache.
+        """
+        key = self.make_key(model_name, system_instruction, file_uris, parts_mode)
+        ttl_seconds = self.ttl.total_seconds()
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+            retry_at = self.failures.get(key)
+        if retry_at is not None and self.clock() < retry_at:
+            raise ContextCacheUnavailable("Cached context creation failed recently")
+
+        # Only requests for the same file set wait on each other's remote calls
+        with key_lock:
+            now = self.clock()
+            with self._lock:
+                entry = self.entries.get(key)
+
+                # Evict an expired context
+                if entry is not None and now >= entry["expires_at"]:
+                    self.entries.pop(key)
+                    expired, entry = entry, None
+                else:
+                    expired = None
+            if expired is not None:
+                self._delete(expired)
+
+            # Extend the context if it is about to expire
+            if entry is not None and entry["expires_at"] - now <= self.refresh_margin.total_seconds():
+                try:
+                    entry["cached_content"].update(ttl=self.ttl)
+                    entry["expires_at"] = now + ttl_seconds
+                except Exception as e:
+                    logging.warning(f"Error refreshing cached context: {e}")
+
+            # Create the context on a miss, remembering failures
+            if entry is None:
+                try:
+                    cached_content = self.create_cached_content(
+                        model_name=model_name,
+                        system_instruction=system_instruction,
+                        contents=contents_factory(),
+                        ttl=self.ttl,
+                    )
+                except Exception:
+                    with self._lock:
+                        self.failures[key] = self.clock() + self.failure_backoff.total_seconds()
+                    raise
+                entry = {
+                    "cached_content": cached_content,
+                    "model": self.model_from_cached_content(cached_content),
+                    "expires_at": now + ttl_seconds,
+                }
+                with self._lock:
+                    self.entries[key] = entry
+                    self.failures.pop(key, None)
+
+            return entry["model"]
+
+    def evict_expired(self):
+        """
+        This function removes every expired context from the cache.
+        """
+        with self._lock:
+            now = self.clock()
+            expired = [
+                self.entries.pop(key)
+                for key in [k for k, v in self.entries.items() if now >= v["expires_at"]]
+            ]
+        for entry in expired:
+            self._delete(entry)
+
+    def clear(self):
+        """
+        This function removes every context from the cache.
+        """
+        with self._lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+            self.failures.clear()
+        for entry in entries:
+            self._delete(entry)
+
+    @staticmethod
+    def _delete(entry: dict):
+        """
+        This function deletes the remote context of a cache entry, ignoring errors.
+        """
+        try:
+            entry["cached_content"].delete()
+        except Exception as e:
+            logging.warning(f"Error deleting cached context: {e}")
+
+
+# Shared cache for all sessions of the app
+context_cache = ContextCache()
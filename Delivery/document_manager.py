@@ -1,19 +1,228 @@
 import streamlit as st
+import hashlib
+import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import pymupdf
 import pypandoc
+from typing import List
+from pdf_export import html_to_pdf, markdown_to_html, memo_to_html
+from pdf_worker import run_pdf_work, submit_pdf_work
+from response_cache import file_content_hash
+
+# Seconds between checks of the background summary exports
+EXPORT_POLL_SECONDS = 2
+
+
+class PageRenderCache:
+    """
+    A process-wide LRU cache of rendered pages, bounded by the total size of the renders.
+    Keys are (document content hash, page number, zoom, format).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int, optional): The maximum total size of the cached renders. Defaults to 256 MB.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        This function returns a cached render and marks it as recently used.
+        Returns:
+            The render, or None if it is not cached.
+        """
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        """
+        This function caches a render, evicting the least recently used renders over the size limit.
+        """
+        value_size = len(value)
+        if value_size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += value_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.entries
+
+
+# Rendering settings of the document viewer
+RASTER_DPI = 110
+JPEG_QUALITY = 80
+IMAGE_AREA_RATIO = 0.5
+MAX_SVG_DRAWINGS = 2000
+MAX_SVG_BYTES = 1024 * 1024
+ZOOM_LEVELS = [0.5, 0.75, 1.0, 1.5, 2.0]
+
+# Shared render cache for all sessions
+page_render_cache = PageRenderCache()
+
+# Summary exports, keyed by summary content hash, generated in the background
+MAX_CACHED_EXPORTS = 64
+export_futures = OrderedDict()
+export_lock = threading.Lock()
+export_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary_export")
+
+
+def document_key(doc):
+    """
+    This function identifies a document by the content hash of its file.
+    Args:
+        doc (pymupdf.Document): The opened document.
+    Returns:
+        str: The content hash, or the object id for documents without a file.
+    """
+    if doc.name and os.path.exists(doc.name):
+        return file_content_hash(doc.name)
+    return f"id:{id(doc)}"
+
+
+def choose_image_format(page):
+    """
+    This function chooses how to render a page based on its content.
+    Scanned and image-heavy pages are rasterized as JPEG, pages with very many vector
+    drawings (e.g. dense charts) as PNG, and text pages are kept as SVG.
+    Args:
+        page (pymupdf.Page): The page to render.
+    Returns:
+        str: "jpeg", "png" or "svg".
+    """
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(pymupdf.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+    if image_area > IMAGE_AREA_RATIO * page_area:
+        return "jpeg"
+    if len(page.get_cdrawings()) > MAX_SVG_DRAWINGS:
+        return "png"
+    return "svg"
+
+
+def rasterize_page(page, zoom: float = 1.0, image_format: str = "png"):
+    """
+    This function renders a page to a compressed raster image.
+    Args:
+        page (pymupdf.Page): The page to render.
+        zoom (float, optional): The zoom factor, applied on top of RASTER_DPI. Defaults to 1.0.
+        image_format (str, optional): "png" or "jpeg". Defaults to "png".
+    Returns:
+        bytes: The encoded image.
+    """
+    pixmap = page.get_pixmap(dpi=int(RASTER_DPI * zoom), alpha=False)
+    if image_format == "jpeg":
+        return pixmap.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
+    return pixmap.tobytes("png")
+
+
+def render_page(doc, page_number: int, zoom: float = 1.0, image_format: str = "auto"):
+    """
+    This function renders a page of a document, reusing cached renders.
+    Pages are drawn on the pymupdf thread, so they are never drawn while background work uses pymupdf.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        page_number (int): The zero-based page number.
+        zoom (float, optional): The zoom factor. Defaults to 1.0.
+        image_format (str, optional): "svg", "png", "jpeg", or "auto" to choose by page content. Defaults to "auto".
+    Returns:
+        The rendered page, as an SVG string or encoded image bytes.
+    """
+    key = (document_key(doc), page_number, zoom, image_format)
+    image = page_render_cache.get(key)
+    if image is None:
+        image = run_pdf_work(draw_page, doc, page_number, zoom, image_format)
+        page_render_cache.set(key, image)
+    return image
+
+
+def draw_page(doc, page_number: int, zoom: float = 1.0, image_format: str = "auto"):
+    """
+    This function draws a page of a document as SVG or a compressed image, without the cache.
+    """
+    page = doc.load_page(page_number)
+    page_format = choose_image_format(page) if image_format == "auto" else image_format
+
+    if page_format == "svg":
+        image = page.get_svg_image(matrix=pymupdf.Matrix(zoom, zoom))
+        # Rasterize pages whose SVG is too large to send to the browser
+        if image_format == "auto" and len(image) > MAX_SVG_BYTES:
+            image = rasterize_page(page, zoom, "png")
+        return image
+    return rasterize_page(page, zoom, page_format)
+
+
+def prefetch_pages(doc, page_numbers, zoom: float = 1.0, image_format: str = "auto"):
+    """
+    This function renders pages in the background so they are cached before they are viewed.
+    The pages are rendered on the pymupdf thread from a separate copy of the document,
+    queued behind any other pymupdf work.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        page_numbers (list): The zero-based page numbers to render.
+        zoom (float, optional): The zoom factor. Defaults to 1.0.
+        image_format (str, optional): The image format. Defaults to "auto".
+    """
+    if not doc.name or not os.path.exists(doc.name):
+        return
+
+    doc_key = document_key(doc)
+    page_numbers = [
+        page_number
+        for page_number in page_numbers
+        if 0 <= page_number < doc.page_count
+        and (doc_key, page_number, zoom, image_format) not in page_render_cache
+    ]
+    if not page_numbers:
+        return
+
+    def render_copies(path):
+        with pymupdf.open(path) as doc_copy:
+            for page_number in page_numbers:
+                render_page(doc_copy, page_number, zoom, image_format)
+
+    submit_pdf_work(render_copies, doc.name)
 
 
 def display_page(doc):
     """
     This function displays a page of a document.
+    The page is rendered once and cached, and the neighboring pages are prefetched.
     """
 
+    # Select the zoom level of the viewer
+    zoom = st.select_slider(
+        "Zoom",
+        options=ZOOM_LEVELS,
+        value=1.0,
+        format_func=lambda level: f"{int(level * 100)}%",
+        key="viewer_zoom",
+    )
+
     # Load the page
-    page = doc.load_page(st.session_state.get("current_page", 1) - 1)
-    # Display the page
-    st.image(page.get_svg_image())
+    page_number = st.session_state.get("current_page", 1) - 1
+    # Display the page as SVG or a compressed image, depending on its content
+    st.image(render_page(doc, page_number, zoom=zoom))
     st.caption(f"Page {st.session_state.get('current_page',1)} of {doc.page_count}")
 
+    # Render the next and previous pages in the background
+    prefetch_pages(doc, [page_number + 1, page_number - 1], zoom=zoom)
+
 
 def navigation_buttons(doc):
     """
@@ -27,10 +236,10 @@ def navigation_buttons(doc):
         # Display button for all pages except the first
         if st.session_state.get("current_page", 1) > 1:
             st.write("\n")
-            # Update page and rerun session
+            # Update page and rerun the viewer
             if st.button("Previous Page", key="prev_button"):
                 st.session_state["current_page"] -= 1
-                st.rerun()
+                st.rerun(scope="fragment")
 
     # Select box for jumping to a specific page
     with col_nav2:
@@ -43,25 +252,27 @@ def navigation_buttons(doc):
                 key="page_selectbox",
             )
 
-            # Jump to the selected page and update page and session
+            # Jump to the selected page and rerun the viewer
             if page_number != st.session_state.get("current_page", 1):
                 st.session_state["current_page"] = page_number
-                st.rerun()
+                st.rerun(scope="fragment")
 
     # Button for next page
     with col_nav3:
         # Display button for all pages except the last
         if st.session_state.get("current_page", 1) < doc.page_count:
             st.write("\n")
-            # Update page and rerun session
+            # Update page and rerun the viewer
             if st.button("Next Page", key="next_button"):
                 st.session_state["current_page"] += 1
-                st.rerun()
+                st.rerun(scope="fragment")
 
 
+@st.fragment
 def render_files():
     """
     This function renders the uploaded files and memo draft in the file viewer.
+    Runs as a fragment, so page navigation only reruns the viewer.
     """
 
     # Display the file viewer with uploaded files
@@ -92,7 +303,9 @@ def render_files():
             display_page(doc=doc)
 
 
-def save_summary_as_docx(summary: str, summary_filename: str, output_filename: str):
+def save_summary_as_docx(
+    summary: str, summary_filename: str, output_filename: str, temp_dir: str = None
+):
     """
     This function saves a chatbot/generated summary as a docx file.
 
@@ -100,6 +313,7 @@ def save_summary_as_docx(summary: str, summary_filename: str, output_filename: s
         summary (str): The summary to be saved.
         summary_filename (str): The filename for the summary.
         output_filename (str): The filename for the output docx file.
+        temp_dir (str, optional): The directory to save to. Defaults to the session temp directory.
 
     Returns:
         output_path (str): The path to the output docx file.
@@ -107,8 +321,9 @@ def save_summary_as_docx(summary: str, summary_filename: str, output_filename: s
     """
 
     # Construct path
-    summary_path = os.path.join(st.session_state.temp_dir, summary_filename)
-    output_path = os.path.join(st.session_state.temp_dir, output_filename)
+    temp_dir = temp_dir or st.session_state.temp_dir
+    summary_path = os.path.join(temp_dir, summary_filename)
+    output_path = os.path.join(temp_dir, output_filename)
 
     # Save the summary to a local path
     with open(summary_path, "w") as f:
@@ -121,19 +336,20 @@ def save_summary_as_docx(summary: str, summary_filename: str, output_filename: s
     return output_path, output_filename
 
 
-def convert_docx_to_pdf(docx_path: str, output_pdf_filename: str):
+def convert_docx_to_pdf(docx_path: str, output_pdf_filename: str, temp_dir: str = None):
     """
     This function converts a docx file to a pdf file.
 
     Args:
         docx_path (str): The path to the docx file.
         output_pdf_filename (str): The filename for the output pdf file.
+        temp_dir (str, optional): The directory to save to. Defaults to the session temp directory.
 
     Returns:
         output_path (str): The path to the output pdf file.
         output_pdf_filename (str): The filename of the output pdf file
     """
-    output_path = os.path.join(st.session_state.temp_dir, output_pdf_filename)
+    output_path = os.path.join(temp_dir or st.session_state.temp_dir, output_pdf_filename)
     pypandoc.convert_file(
         docx_path,
         "pdf",
@@ -144,9 +360,155 @@ def convert_docx_to_pdf(docx_path: str, output_pdf_filename: str):
     return output_path, output_pdf_filename
 
 
+def save_as_pdf(
+    body_html: str, output_pdf_filename: str, temp_dir: str = None, docx_path: str = None
+):
+    """
+    This function saves HTML as a pdf file in-process, falling back to pandoc.
+    Set PDF_BACKEND=pandoc to always convert the docx file with pandoc and pdflatex.
+    Args:
+        body_html (str): The HTML document body.
+        output_pdf_filename (str): The filename for the output pdf file.
+        temp_dir (str, optional): The directory to save to. Defaults to the session temp directory.
+        docx_path (str, optional): The docx file converted by the pandoc fallback.
+    Returns:
+        output_path (str): The path to the output pdf file.
+        output_pdf_filename (str): The filename of the output pdf file
+    """
+    temp_dir = temp_dir or st.session_state.temp_dir
+    if os.getenv("PDF_BACKEND", "native") != "pandoc":
+        try:
+            output_path = os.path.join(temp_dir, output_pdf_filename)
+            run_pdf_work(html_to_pdf, body_html, output_path)
+            return output_path, output_pdf_filename
+        except Exception as e:
+            if docx_path is None:
+                raise
+            logging.warning(f"Falling back to pandoc for pdf export: {e}")
+
+    if docx_path is None:
+        raise ValueError("The pandoc pdf export needs the docx file, which could not be created.")
+
+    return convert_docx_to_pdf(
+        docx_path=docx_path, output_pdf_filename=output_pdf_filename, temp_dir=temp_dir
+    )
+
+
+def save_memo_as_pdf(
+    memo_text: str,
+    output_pdf_filename: str,
+    heading_titles: List[str],
+    subheading_titles: List[str],
+    temp_dir: str = None,
+    docx_path: str = None,
+):
+    """
+    This function saves the memo as a pdf file, with the headings and subheadings of the docx memo.
+    Args:
+        memo_text (str): The memo text.
+        output_pdf_filename (str): The filename for the output pdf file.
+        heading_titles (list): A list of heading titles.
+        subheading_titles (list): A list of subheading titles.
+        temp_dir (str, optional): The directory to save to. Defaults to the session temp directory.
+        docx_path (str, optional): The docx memo converted by the pandoc fallback.
+    Returns:
+        output_path (str): The path to the output pdf file.
+        output_pdf_filename (str): The filename of the output pdf file
+    """
+    return save_as_pdf(
+        memo_to_html(memo_text, heading_titles, subheading_titles),
+        output_pdf_filename,
+        temp_dir=temp_dir,
+        docx_path=docx_path,
+    )
+
+
+def export_summary(summary: str, summary_name: str, temp_dir: str):
+    """
+    This function exports a summary to docx and pdf files.
+    Args:
+        summary (str): The summary to be exported.
+        summary_name (str): The file name stem of the exports.
+        temp_dir (str): The directory to save to.
+    Returns:
+        dict: The docx and pdf file contents, or the exception raised while exporting each.
+    """
+    exports = {"docx": None, "pdf": None}
+
+    # Save the summary as a docx file
+    docx_output_path = None
+    try:
+        docx_output_path, _ = save_summary_as_docx(
+            summary=summary,
+            summary_filename=f"{summary_name}.md",
+            output_filename=f"{summary_name}.docx",
+            temp_dir=temp_dir,
+        )
+        with open(docx_output_path, "rb") as f:
+            exports["docx"] = f.read()
+    except Exception as e:
+        exports["docx"] = e
+        docx_output_path = None
+
+    # Render the summary as a pdf file, which does not need the docx file unless falling back to pandoc
+    try:
+        pdf_output_path, _ = save_as_pdf(
+            markdown_to_html(summary),
+            output_pdf_filename=f"{summary_name}.pdf",
+            temp_dir=temp_dir,
+            docx_path=docx_output_path,
+        )
+        with open(pdf_output_path, "rb") as f:
+            exports["pdf"] = f.read()
+    except Exception as e:
+        exports["pdf"] = e
+
+    return exports
+
+
+def get_summary_exports(summary: str, summary_name: str, temp_dir: str):
+    """
+    This function returns the exports of a summary, generating them in the background on first request.
+    Exports are keyed by the content hash of the summary, so they are only generated once per text.
+    Args:
+        summary (str): The summary to be exported.
+        summary_name (str): The file name stem of the exports.
+        temp_dir (str): The directory to save to.
+    Returns:
+        Future: Resolves to the result of export_summary.
+    """
+    summary_hash = hashlib.sha256(summary.encode("utf-8")).hexdigest()
+    key = (summary_hash, summary_name, temp_dir)
+
+    with export_lock:
+        if key not in export_futures:
+            # Use a file name per content hash so concurrent exports do not overwrite each other
+            export_futures[key] = export_executor.submit(
+                export_summary, summary, f"{summary_name}_{summary_hash[:12]}", temp_dir
+            )
+            if len(export_futures) > MAX_CACHED_EXPORTS:
+                export_futures.popitem(last=False)
+        return export_futures[key]
+
+
+@st.fragment(run_every=EXPORT_POLL_SECONDS)
+def poll_exports(exports_future: Future):
+    """
+    This function shows the export progress and reruns the app once the exports are ready,
+    so the download buttons appear without the user refreshing.
+    Args:
+        exports_future (Future): The exports being generated in the background.
+    """
+    if exports_future.done():
+        st.rerun()
+    st.caption("Preparing the docx and pdf files...")
+
+
 def display_download_buttons(summary_name: str = "summary"):
     """
     This function displays buttons for downloading a summary as a docx, pdf, or txt.
+    The docx and pdf files are generated in the background once per summary text, from its rendered markdown.
+    The txt file holds the structured summary.
     Args:
         summary_name (str, optional): The name of the summary to be downloaded.
         Defaults to "summary".
@@ -155,51 +517,39 @@ def display_download_buttons(summary_name: str = "summary"):
     # Determine the summary content and button text based on the summary name
     if summary_name == "summary":
         summary_content = st.session_state.summary
+        display_content = st.session_state.display_summary
         button_display_text = "Download summary"
 
     elif summary_name == "chatbot_summary":
         summary_content = st.session_state.latest_editor_chatbot_response
+        display_content = st.session_state.latest_editor_display_response
         button_display_text = "Download the latest edit"
 
-    # Save the summary as a docx file
-    try:
-        docx_output_path, docx_output_filename = save_summary_as_docx(
-            summary=summary_content,
-            summary_filename=f"{summary_name}.md",
-            output_filename=f"{summary_name}.docx",
-        )
-    except Exception as e:
-        st.error(f"Error saving as a docx file: {e}")
-        docx_output_path, docx_output_filename = None, None
-
-    # Save the summary as a pdf file using the docx file
-    try:
-        pdf_output_path, pdf_output_filename = convert_docx_to_pdf(
-            docx_path=docx_output_path, output_pdf_filename=f"{summary_name}.pdf"
-        )
-    except Exception as e:
-        st.error(f"Error saving as a pdf file: {e}")
-        pdf_output_path, pdf_output_filename = None, None
+    # Fetch the exports, which are generated in the background
+    exports_future = get_summary_exports(
+        display_content, summary_name, st.session_state.temp_dir
+    )
+    exports = exports_future.result() if exports_future.done() else None
 
     # Display download buttons
     col1, col2, col3 = st.columns(3)
 
-    # Download button for docx
-    with col1:
-        if docx_output_path is not None and docx_output_filename is not None:
-            _ = st.download_button(
-                label=f"{button_display_text} as a docx!",
-                data=open(docx_output_path, "rb").read(),
-                file_name=docx_output_filename,
-            )
-    # Download button for pdf
-    with col2:
-        if pdf_output_path is not None and pdf_output_filename is not None:
-            _ = st.download_button(
-                label=f"{button_display_text} as a pdf!",
-                data=open(pdf_output_path, "rb").read(),
-                file_name=pdf_output_filename,
-            )
+    if exports is None:
+        # Check the exports in the background until they are ready
+        with col1:
+            poll_exports(exports_future)
+    else:
+        for column, export_format in [(col1, "docx"), (col2, "pdf")]:
+            with column:
+                if isinstance(exports[export_format], Exception):
+                    st.error(f"Error saving as a {export_format} file: {exports[export_format]}")
+                else:
+                    _ = st.download_button(
+                        label=f"{button_display_text} as a {export_format}!",
+                        data=exports[export_format],
+                        file_name=f"{summary_name}.{export_format}",
+                    )
+
     # Download button for txt
     with col3:
         _ = st.download_button(
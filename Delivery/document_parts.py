@@ -0,0 +1,210 @@
+import logging
+import os
+import re
+from typing import Dict, List
+import pymupdf
+
+# Pages with less text than this are treated as scans or graphics
+MIN_TEXT_CHARS = 200
+
+# Pages whose images cover more than this fraction of the page are sent as PDF
+MAX_IMAGE_COVERAGE = 0.3
+
+# Pages with more vector drawings than this are treated as charts
+MAX_DRAWINGS = 300
+
+# Budget of the text and PDF excerpts sent inline with a request, across all of its files.
+# Files over the budget are sent whole from GCS instead.
+MAX_INLINE_BYTES = 15 * 1024 * 1024
+
+
+def use_hybrid_parts() -> bool:
+    """
+    This function returns whether documents are sent as extracted text plus PDF excerpts.
+    Set DOCUMENT_PARTS=pdf to send the whole PDF files instead.
+    """
+    return os.getenv("DOCUMENT_PARTS", "hybrid").lower() != "pdf"
+
+
+def image_coverage(page) -> float:
+    """
+    This function computes the fraction of a page covered by images.
+    Args:
+        page (pymupdf.Page): The page.
+    Returns:
+        float: The covered fraction, between 0 and 1.
+    """
+    page_area = abs(page.rect) or 1
+    covered = sum(
+        abs(pymupdf.Rect(image["bbox"]) & page.rect) for image in page.get_image_info()
+    )
+    return min(covered / page_area, 1.0)
+
+
+def classify_page(page, text: str) -> str:
+    """
+    This function classifies a page as text or visual.
+    Visual pages are scans, image-heavy pages and charts, which need to be seen by the model.
+    Args:
+        page (pymupdf.Page): The page.
+        text (str): The text of the page.
+    Returns:
+        str: "text" or "visual".
+    """
+    if len(text.strip()) < MIN_TEXT_CHARS:
+        return "visual"
+    if image_coverage(page) > MAX_IMAGE_COVERAGE:
+        return "visual"
+    if len(page.get_cdrawings()) > MAX_DRAWINGS:
+        return "visual"
+    return "text"
+
+
+def extract_page_content(page) -> str:
+    """
+    This function extracts the text of a page in reading order, with its tables as markdown.
+    Args:
+        page (pymupdf.Page): The page.
+    Returns:
+        str: The text of the page.
+    """
+    # Tables are drawn with ruling lines, so skip the table search on pages without drawings
+    tables = page.find_tables().tables if page.get_cdrawings() else []
+    table_rects = [pymupdf.Rect(table.bbox) for table in tables]
+
+    items = [(table.bbox[1], table.bbox[0], table.to_markdown(clean=False)) for table in tables]
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks"):
+        rect = pymupdf.Rect(x0, y0, x1, y1)
+        if block_type != 0 or any(rect.intersects(table_rect) for table_rect in table_rects):
+            continue
+        items.append((y0, x0, text.strip()))
+
+    return "\n".join(text for _, _, text in sorted(items, key=lambda item: item[:2]) if text)
+
+
+def page_subset_bytes(doc, first_page: int, last_page: int) -> bytes:
+    """
+    This function copies a range of pages of a document into a new PDF.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        first_page (int): The zero-based index of the first page.
+        last_page (int): The zero-based index of the last page, inclusive.
+    Returns:
+        bytes: The PDF with the pages.
+    """
+    source = doc if doc.is_pdf else pymupdf.open("pdf", doc.convert_to_pdf())
+    subset = pymupdf.open()
+    subset.insert_pdf(source, from_page=first_page, to_page=last_page)
+    return subset.tobytes(garbage=3, deflate=True)
+
+
+def build_parts_plan(doc, file_name: str) -> List[Dict]:
+    """
+    This function splits a document into text segments and PDF excerpts of its visual pages.
+    Consecutive pages of the same kind are grouped, and every page keeps its original page number.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        file_name (str): The name of the document.
+    Returns:
+        list: The segments in page order, or None if the whole file should be sent instead.
+    """
+    segments = []
+    text_pages = 0
+    for page_index, page in enumerate(doc):
+        text = page.get_text()
+        kind = classify_page(page, text)
+
+        if kind == "text":
+            text_pages += 1
+            content = f"[{file_name}, page {page_index + 1}]\n{extract_page_content(page)}"
+            if segments and segments[-1]["type"] == "text":
+                segments[-1]["text"] += "\n\n" + content
+            else:
+                segments.append({"type": "text", "text": content})
+        elif segments and segments[-1]["type"] == "pages":
+            segments[-1]["last_page"] = page_index
+        else:
+            segments.append({"type": "pages", "first_page": page_index, "last_page": page_index})
+
+    # Nothing to gain when every page is visual
+    if text_pages == 0:
+        return None
+
+    for segment in segments:
+        if segment["type"] == "pages":
+            segment["data"] = page_subset_bytes(doc, segment["first_page"], segment["last_page"])
+
+    inline_bytes = plan_inline_bytes(segments)
+    if inline_bytes > MAX_INLINE_BYTES:
+        logging.info(f"{file_name}: pages too large to send inline, sending the whole file")
+        return None
+
+    logging.info(
+        f"{file_name}: {text_pages} text pages, {doc.page_count - text_pages} visual pages "
+        f"({inline_bytes / 1024:.0f} KB inline)"
+    )
+    return segments
+
+
+def plan_inline_bytes(parts_plan: List[Dict]) -> int:
+    """
+    This function computes the bytes a parts plan adds to a request, its text and PDF excerpts.
+    """
+    return sum(
+        len(segment["text"].encode("utf-8")) if segment["type"] == "text" else len(segment["data"])
+        for segment in parts_plan
+    )
+
+
+def files_over_inline_budget(inline_bytes: Dict[str, int], max_bytes: int = MAX_INLINE_BYTES) -> List[str]:
+    """
+    This function picks the files to send whole so the inline parts of a request fit the budget.
+    The largest files are picked first, so as few files as possible lose their hybrid parts.
+    Args:
+        inline_bytes (dict): The inline bytes of each file sent with the request.
+        max_bytes (int, optional): The inline budget of the request. Defaults to MAX_INLINE_BYTES.
+    Returns:
+        list: The names of the files to send whole.
+    """
+    total = sum(inline_bytes.values())
+    send_whole = []
+    for file_name, size in sorted(inline_bytes.items(), key=lambda item: item[1], reverse=True):
+        if total <= max_bytes:
+            break
+        send_whole.append(file_name)
+        total -= size
+    if send_whole:
+        logging.info(f"Inline parts over {max_bytes / 1e6:.0f} MB, sending whole: {', '.join(send_whole)}")
+    return send_whole
+
+
+def describe_segment(file_name: str, segment: Dict) -> str:
+    """
+    This function labels a PDF excerpt with its original page numbers.
+    """
+    first_page, last_page = segment["first_page"] + 1, segment["last_page"] + 1
+    pages = f"page {first_page}" if first_page == last_page else f"pages {first_page}-{last_page}"
+    return f"[{file_name}, {pages}] The following PDF excerpt contains {pages} of the original document."
+
+
+def describe_file(file_name: str) -> str:
+    """
+    This function labels a whole file sent from GCS with its file name.
+    """
+    return f"[{file_name}] The following file contains the whole document."
+
+
+def parse_segment_label(text: str):
+    """
+    This function reads the file name and first page back from a label written by describe_segment or describe_file.
+    Args:
+        text (str): The label.
+    Returns:
+        tuple: The file name and the one-based first page, or None if the text is not a label.
+    """
+    match = re.match(
+        r"^\[(.+?)(?:, pages? (\d+)(?:-\d+)?)?\] The following (?:PDF excerpt|file contains)", text
+    )
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2) or 1)
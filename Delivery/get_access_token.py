@@ -1,33 +1,167 @@
 import os
+import time
 import logging
+import threading
 import oauthlib.oauth2.rfc6749.errors
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 from fastapi import HTTPException
 
-# Function to get the access token
-def get_access_token(token_url, api_url): 
-    # Function to get environment variable
-    def get_env(key, default=None):
-        value = os.environ.get(key, default)
-        if value == 'True' or value == 'true':
-            value = True
-        elif value == 'False' or value == 'false':
-            value = False
-        return value
+# Refresh the token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 120
+
+# Lifetime assumed for tokens returned without expires_in
+DEFAULT_TOKEN_LIFETIME = 3600
+
+# Seconds to wait before retrying a failed background refresh
+TOKEN_RETRY_DELAY = 30
+
+
+# Function to get environment variable
+def get_env(key, default=None):
+    value = os.environ.get(key, default)
+    if value == 'True' or value == 'true':
+        value = True
+    elif value == 'False' or value == 'false':
+        value = False
+    return value
+
+
+class TokenManager:
+    """
+    A process-wide cache of the client-credentials access token for an OAuth endpoint.
+    The token is reused until shortly before it expires and is then refreshed in the
+    background by a timer, so idle periods do not leave an expired token behind.
+    Concurrent callers needing a new token wait on a single refresh.
+    """
+
+    def __init__(self, token_url, client_id, client_secret,
+                 refresh_margin=TOKEN_REFRESH_MARGIN, clock=time.monotonic):
+        """
+        Args:
+            token_url (str): The OAuth token endpoint.
+            client_id (str): The client ID.
+            client_secret (str): The client secret.
+            refresh_margin (float, optional): Seconds before expiry to refresh the token.
+            clock (Callable, optional): Returns the current time in seconds.
+        """
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.access_token = None
+        self.expires_at = 0
+        self.refresh_count = 0
+        self._session = OAuth2Session(client=BackendApplicationClient(client_id=client_id))
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._timer = None
+
+    def get_token(self):
+        """
+        This function returns a valid access token, fetching a new one only when needed.
+        Returns:
+            str: The access token.
+        """
+        now = self.clock()
+
+        # Fast path: the token is valid and not about to expire
+        if self.access_token and now < self.expires_at - self.refresh_margin:
+            return self.access_token
+
+        # The token is still valid but expiring soon: refresh it in the background
+        if self.access_token and now < self.expires_at:
+            self._start_background_refresh()
+            return self.access_token
+
+        # No valid token: fetch one, coalescing concurrent callers
+        with self._lock:
+            if not self.access_token or self.clock() >= self.expires_at:
+                self._refresh()
+            return self.access_token
 
+    def _start_background_refresh(self):
+        """
+        This function starts a single background refresh of the token.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    self._refresh()
+            except HTTPException:
+                # The current token remains valid until it expires, retry before then
+                with self._lock:
+                    if self.clock() + TOKEN_RETRY_DELAY < self.expires_at:
+                        self._schedule_refresh(TOKEN_RETRY_DELAY)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, name="token_refresh", daemon=True).start()
+
+    def _refresh(self):
+        """
+        This function fetches a new token from the token endpoint. Must be called holding the lock.
+        """
+        try:
+            token = self._session.fetch_token(
+                token_url=self.token_url, client_id=self.client_id, client_secret=self.client_secret
+            )
+        except oauthlib.oauth2.rfc6749.errors.OAuth2Error as e:
+            logging.error(f"Error fetching access token: {e}")
+            raise HTTPException(status_code=500, detail="Error fetching access token")
+        except Exception as e:
+            logging.error(f"Error fetching access token: {e}")
+            raise HTTPException(status_code=500, detail="Error fetching access token")
+
+        self.access_token = token['access_token']
+        self.expires_at = self.clock() + float(token.get('expires_in') or DEFAULT_TOKEN_LIFETIME)
+        self.refresh_count += 1
+        self._schedule_refresh(self.expires_at - self.refresh_margin - self.clock())
+
+    def _schedule_refresh(self, delay):
+        """
+        This function schedules the next background refresh, replacing any scheduled one.
+        Must be called holding the lock.
+        Args:
+            delay (float): Seconds until the refresh.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 0), self._start_background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+
+# Token managers shared by all sessions, keyed by token endpoint and client
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(token_url):
+    """
+    This function returns the process-wide token manager for a token endpoint.
+    The client ID and secret are read from the CLIENT_ID and CLIENT_SECRET environment variables.
+    Args:
+        token_url (str): The OAuth token endpoint.
+    Returns:
+        TokenManager: The shared token manager.
+    """
     client_id = (get_env("CLIENT_ID"))
     client_secret = (get_env("CLIENT_SECRET"))
 
-    client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client)
-
-    try:
-        token = oauth.fetch_token(token_url=token_url, client_id=client_id, client_secret=client_secret)
-        return token['access_token'] 
-    except oauthlib.oauth2.rfc6749.errors.OAuth2Error as e:
-        logging.error(f"Error fetching access token: {e}")
-        raise HTTPException(status_code=500, detail="Error fetching access token")
-    except Exception as e:
-        logging.error(f"Error fetching access token: {e}")
-        raise HTTPException(status_code=500, detail="Error fetching access token")
+    key = (token_url, client_id, client_secret)
+    with _token_managers_lock:
+        if key not in _token_managers:
+            _token_managers[key] = TokenManager(token_url, client_id, client_secret)
+        return _token_managers[key]
+
+
+# Function to get the access token
+def get_access_token(token_url, api_url):
+    return get_token_manager(token_url).get_token()
@@ -1,7 +1,38 @@
 from vertexai.generative_models import GenerativeModel, Part
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 from dotenv import load_dotenv
+import json
+import logging
 import os
+import statistics
+import time
+from context_cache import context_cache
+from response_cache import response_cache, files_content_hashes, make_cache_key
+from secure_gpt_api import SECURE_GPT_MODEL, SecureGPTModel
+from document_parts import (
+    describe_file,
+    describe_segment,
+    files_over_inline_budget,
+    page_subset_bytes,
+    plan_inline_bytes,
+)
+from model_router import (
+    PrependedContentsModel,
+    RoutedModel,
+    hedged_tasks,
+    route_models,
+    router_enabled,
+)
+from pdf_worker import run_pdf_work
+from preflight import (
+    MAP_REDUCE,
+    SECTION_PARALLEL,
+    choose_strategy,
+    describe_plan,
+    estimate_file_tokens,
+    estimate_tokens,
+)
 
 # Define the system instructions for the editor chatbot
 EDITOR_SYSTEM_INSTRUCTIONS = """
@@ -23,71 +54,510 @@ QA_SYSTEM_INSTRUCTIONS = """
     Be friendly and helpful. Include page numbers for references.
     """
 
+# Approximate token budget and number of verbatim messages of the chat history
+HISTORY_TOKEN_BUDGET = 16000
+HISTORY_KEEP_LAST = 6
+
+# Page ranges and parallel requests of map-reduce
+MAP_REDUCE_PAGES_PER_CHUNK = 40
+MAP_REDUCE_CONCURRENCY = 4
+
+# Number of sections generated in parallel, and attempts per section
+SECTION_CONCURRENCY = 6
+SECTION_MAX_ATTEMPTS = 3
+
+# Define the structured output of summaries, rendered to markdown tables locally
+SUMMARY_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "fields": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "field": {"type": "string"},
+                                "value": {"type": "string"},
+                                "pages": {"type": "string"},
+                            },
+                            "required": ["field", "value", "pages"],
+                        },
+                    },
+                },
+                "required": ["title", "fields"],
+            },
+        }
+    },
+    "required": ["sections"],
+}
+
+# Map the chatbot functions to their system instructions
+SYSTEM_INSTRUCTIONS = {
+    "editor": EDITOR_SYSTEM_INSTRUCTIONS,
+    "qa": QA_SYSTEM_INSTRUCTIONS,
+}
+
 
 # Create a client for the Generative Model
-def create_client(model_name: str = "gemini-2.0-flash", chatbot_function: str = None):
+def create_client(
+    model_name: str = "gemini-2.0-flash",
+    chatbot_function: str = None,
+    generation_config: dict = None,
+    task: str = None,
+):
     """
-    This function creates a Gemini client.
+    This function creates a model client. Clients for a task route its requests by the task's
+    policy, falling back to another model on 429 and 5xx errors.
+    Args:
+        model_name (str, optiona): The name of the selected model. Defaults to "gemini-2.0-flash".
+        chatbot_function (str, optional): The chatbot function to use. Specifies system instructions. Defaults to None.
+        generation_config (dict, optional): The generation defaults of the client. Defaults to None.
+        task (str, optional): The task, "summary", "memo", "markdown", "qa" or "editor". Defaults to the chatbot function.
+    Returns:
+        A RoutedModel object, or a single model client if there is no task or routing is disabled.
+    """
+    task = task or chatbot_function
+    if task is None or not router_enabled():
+        return create_model_client(model_name, chatbot_function, generation_config)
+
+    return RoutedModel(
+        task,
+        route_models(task, model_name),
+        lambda name: create_model_client(name, chatbot_function, generation_config),
+        hedge=task in hedged_tasks(),
+    )
+
+
+def create_model_client(
+    model_name: str = "gemini-2.0-flash",
+    chatbot_function: str = None,
+    generation_config: dict = None,
+):
+    """
+    This function creates a Gemini client, or a Secure GPT client with the same interface.
     Args:
         model_name (str, optiona): The name of the model to use. Defaults to "gemini-2.0-flash".
         chatbot_function (str, optional): The chatbot function to use. Specifies system instructions. Defaults to None.
+        generation_config (dict, optional): The generation defaults of the client. Defaults to None.
     Returns:
-        A GenerativeModel object.
+        A GenerativeModel object, or a SecureGPTModel object for the Secure GPT option.
     """
-    if chatbot_function == "editor":
+    if model_name == SECURE_GPT_MODEL:
+        return SecureGPTModel(
+            system_instruction=SYSTEM_INSTRUCTIONS.get(chatbot_function),
+            generation_config=generation_config,
+        )
+
+    if chatbot_function in SYSTEM_INSTRUCTIONS:
         return GenerativeModel(
-            model_name, system_instruction=EDITOR_SYSTEM_INSTRUCTIONS
+            model_name,
+            system_instruction=SYSTEM_INSTRUCTIONS[chatbot_function],
+            generation_config=generation_config,
+        )
+
+    return GenerativeModel(model_name, generation_config=generation_config)
+
+
+def create_cached_client(
+    model_name: str,
+    files: Dict[str, Dict[str, str]],
+    chatbot_function: str = None,
+    documents_only: bool = False,
+    fallback=None,
+):
+    """
+    This function creates a Gemini client bound to a cached context holding the files.
+    The cached context is shared by every turn and session using the same model,
+    system instructions and files, so the files are not resent with each request.
+    With a fallback client, requests are routed like the fallback's task: they are hedged if the task
+    is hedged, and sent to the fallback with the files on 429 and 5xx errors. Only this client hedges,
+    so the fallback is used without hedging.
+    Args:
+        model_name (str): The name of the model to use.
+        files (dict): A dictionary containing the file locations in GCS.
+        chatbot_function (str, optional): The chatbot function to use. Specifies system instructions. Defaults to None.
+        documents_only (bool, optional): Whether to cache only the documents. Defaults to False.
+        fallback (optional): The uncached client of the task, e.g. from the model registry. Defaults to None.
+    Returns:
+        A GenerativeModel or RoutedModel object, or None if the files could not be cached.
+    """
+    # Context caching is a Vertex AI feature
+    if model_name == SECURE_GPT_MODEL:
+        return None
+
+    cached_files = [
+        file_locations
+        for file_locations in files.values()
+        if "gcs_file_location" in file_locations
+        and (not documents_only or file_locations["file_type"] == "document")
+    ]
+    if not cached_files:
+        return None
+
+    # Files uploaded with a parts plan are sent as extracted text plus PDF excerpts
+    parts_mode = "pdf"
+    if any(file_locations.get("parts_plan") for file_locations in cached_files):
+        parts_mode = "hybrid"
+
+    try:
+        cached_model = context_cache.get_model(
+            model_name=model_name,
+            system_instruction=SYSTEM_INSTRUCTIONS.get(chatbot_function),
+            file_uris=[file_locations["gcs_file_location"] for file_locations in cached_files],
+            contents_factory=lambda: load_part_from_gcs(files, documents_only),
+            parts_mode=parts_mode,
         )
+    except Exception as e:
+        # Caching is unavailable, e.g. the files are below the minimum cache size
+        logging.warning(f"Falling back to uncached context: {e}")
+        return None
+
+    if fallback is None or chatbot_function is None or not router_enabled():
+        return cached_model
+
+    # Hedge here only, so a slow turn is duplicated at most once
+    if hasattr(fallback, "unhedged"):
+        fallback = fallback.unhedged()
+
+    # The fallback does not hold the files, so they are sent with its requests
+    clients = {
+        "cached": cached_model,
+        "uncached": PrependedContentsModel(
+            fallback, lambda: load_part_from_gcs(files, documents_only)
+        ),
+    }
+    return RoutedModel(
+        chatbot_function,
+        list(clients),
+        clients.get,
+        hedge=chatbot_function in hedged_tasks(),
+        # Share the latencies of the task, as the router is rebuilt for every turn
+        latencies=getattr(fallback, "latencies", None),
+    )
+
+
+def stream_text(responses) -> Iterator[str]:
+    """
+    This function yields the text of a streamed Gemini response chunk by chunk.
+    Args:
+        responses (Iterable[GenerationResponse]): The response stream from generate_content.
+    Returns:
+        Iterator[str]: The text of each chunk as it arrives.
+    """
+    for chunk in responses:
+        # Skip chunks without text, e.g. the final chunk containing only metadata
+        try:
+            text = chunk.text
+        except (ValueError, IndexError):
+            continue
+        if text:
+            yield text
+
+
+def is_file_part(content, file_uris: set) -> bool:
+    """
+    This function checks whether a content is a Part cut from or pointing to the given files.
+    Inline PDF excerpts are cut from the files, so the file hashes identify them too.
+    """
+    if not isinstance(content, Part) or not file_uris:
+        return False
+    part = content.to_dict()
+    return "inline_data" in part or part.get("file_data", {}).get("file_uri") in file_uris
+
+
+def generate_text(
+    model,
+    contents: list,
+    generation_config: dict,
+    files: Dict[str, Dict[str, str]] = None,
+    stream: bool = False,
+):
+    """
+    This function generates a response, reusing a cached response for identical requests.
+    Requests are identified by the model, system instructions, prompts, generation config
+    and the content hashes of the input files.
+    Args:
+        model (GemerativeModel): A GenerativeModel object.
+        contents (list): The contents to send to the model.
+        generation_config (dict): The generation config.
+        files (dict, optional): The files whose parts are included in the contents.
+        stream (bool, optional): Whether to stream the response. Defaults to False.
+    Returns:
+        A string containing the response, or an iterator of text chunks if streaming.
+    """
+    files = files or {}
+
+    # Identify the file parts by content hash instead of GCS location
+    file_uris = {
+        file_locations["gcs_file_location"]
+        for file_locations in files.values()
+        if "gcs_file_location" in file_locations
+    }
+    key_contents = [
+        content for content in contents if not is_file_part(content, file_uris)
+    ]
+    system_instruction = getattr(model, "_system_instruction", None)
+    key = make_cache_key(
+        model_name=getattr(model, "_model_name", type(model).__name__),
+        system_instruction=str(system_instruction) if system_instruction else None,
+        contents=key_contents,
+        generation_config=generation_config,
+        file_hashes=files_content_hashes(files),
+    )
+
+    cached_response = response_cache.get(key)
+    if cached_response is not None:
+        logging.info(f"Response cache hit: {response_cache.stats()}")
+        return iter([cached_response]) if stream else cached_response
+
+    # Stream the response and cache it once complete
+    if stream:
+        responses = model.generate_content(
+            contents=contents, generation_config=generation_config, stream=True
+        )
+
+        def stream_and_cache():
+            chunks = []
+            for chunk in stream_text(responses):
+                chunks.append(chunk)
+                yield chunk
+            response_cache.set(key, "".join(chunks))
+
+        return stream_and_cache()
+
+    # Generate the response
+    response = model.generate_content(
+        contents=contents, generation_config=generation_config
+    )
+    response_cache.set(key, response.text)
+    return response.text
 
-    elif chatbot_function == "qa":
-        return GenerativeModel(model_name, system_instruction=QA_SYSTEM_INSTRUCTIONS)
 
-    return GenerativeModel(model_name)
+def create_generation_config(temperature: float, structured: bool = False):
+    """
+    This function creates the generation config for a request.
+    Args:
+        temperature (float): The temperature for the model generation.
+        structured (bool, optional): Whether to request a summary following SUMMARY_RESPONSE_SCHEMA. Defaults to False.
+    Returns:
+        dict: The generation config.
+    """
+    generation_config = {"temperature": temperature}
+    if structured:
+        generation_config["response_mime_type"] = "application/json"
+        generation_config["response_schema"] = SUMMARY_RESPONSE_SCHEMA
+    return generation_config
 
 
 def load_part_from_gcs(files: Dict[str, Dict[str, str]], documents_only: bool = False):
     """
-    This function loads the PDF files from GCS and returns a list of Part objects for the LLM.
+    This function loads the files for the LLM.
+    Files with a parts plan are sent as their extracted text, with only the visual pages
+    as PDF excerpts. Other files are loaded from GCS as whole PDF files, as are the largest
+    files when the inline parts of all files exceed MAX_INLINE_BYTES.
     Args:
         files (dict): A dictionary containing the locations of the files in GCS.
         documents_only (bool, optional): Whether to load only the documents. Defaults to False.
     Returns:
-        A list of Part objects.
+        A list of prompt strings and Part objects.
     """
 
-    lst_pdf_files = []
+    contents = []
 
-    # Load the PDF files
-    for _, file_locations in files.items():
-        if "gcs_file_location" in file_locations:
-            pdf_file = Part.from_uri(
-                uri=file_locations["gcs_file_location"],
-                mime_type=file_locations["mime_type"],
+    files = {
+        file_name: file_locations
+        for file_name, file_locations in files.items()
+        if "gcs_file_location" in file_locations
+        and (not documents_only or file_locations["file_type"] == "document")
+    }
+
+    # Keep the inline parts of the whole request within the request size limit
+    send_whole = files_over_inline_budget(
+        {
+            file_name: plan_inline_bytes(file_locations["parts_plan"])
+            for file_name, file_locations in files.items()
+            if file_locations.get("parts_plan")
+        }
+    )
+
+    for file_name, file_locations in files.items():
+        # Send the text pages as text and the visual pages as PDF excerpts
+        parts_plan = file_locations.get("parts_plan")
+        if parts_plan and file_name not in send_whole:
+            contents.append(
+                f'The file "{file_name}" is given as the text of its pages and PDF excerpts of its charts, '
+                "images and scans. The page numbers in brackets are the original page numbers."
             )
-            if documents_only and file_locations["file_type"] == "document":
-                lst_pdf_files.append(pdf_file)
-            else:
-                lst_pdf_files.append(pdf_file)
+            for segment in parts_plan:
+                if segment["type"] == "text":
+                    contents.append(segment["text"])
+                else:
+                    contents.append(describe_segment(file_name, segment))
+                    contents.append(
+                        Part.from_data(data=segment["data"], mime_type="application/pdf")
+                    )
+            continue
+
+        # Load the PDF file
+        contents += load_file_part(file_name, file_locations)
+
+    return contents
+
+
+def load_file_part(file_name: str, file_locations: Dict[str, str]) -> list:
+    """
+    This function loads a whole file from GCS, after a label with its file name.
+    The blobs are named by content hash, so the label is what names the file for the model.
+    Args:
+        file_name (str): The name of the file.
+        file_locations (dict): The file locations in GCS.
+    Returns:
+        list: The label and the Part object.
+    """
+    return [
+        describe_file(file_name),
+        Part.from_uri(
+            uri=file_locations["gcs_file_location"],
+            mime_type=file_locations["mime_type"],
+        ),
+    ]
+
+
+def template_sections(files: Dict[str, Dict[str, str]]) -> List[str]:
+    """
+    This function lists the section titles of the uploaded templates.
+    Args:
+        files (dict): A dictionary containing the file locations and opened documents.
+    Returns:
+        list: The section titles, empty if the outlines cannot be parsed.
+    """
+    return [
+        title
+        for file_locations in files.values()
+        if file_locations.get("file_type") == "template" and "doc" in file_locations
+        for title in run_pdf_work(parse_template_outline, file_locations["doc"])
+    ]
+
+
+def plan_request(
+    model,
+    files: Dict[str, Dict[str, str]],
+    task: str,
+    documents_only: bool = False,
+    section_count: int = 0,
+    allow_sections: bool = True,
+):
+    """
+    This function estimates the input tokens of a request before it is sent and picks its strategy.
+    Tokens are counted with the model when it supports count_tokens, and estimated locally from
+    the page statistics otherwise. Estimates are cached per file content.
+    Args:
+        model (GemerativeModel): A GenerativeModel object.
+        files (dict): A dictionary containing the file locations in GCS.
+        task (str): The task, "summary", "memo" or "qa".
+        documents_only (bool, optional): Whether only the documents are sent. Defaults to False.
+        section_count (int, optional): The number of sections that could be generated in parallel. Defaults to 0.
+        allow_sections (bool, optional): Whether sections may be generated in parallel. Defaults to True.
+    Returns:
+        dict: The task, estimated input tokens, counting method, strategy and the reason for it.
+    """
+    input_tokens = 0
+    methods = set()
+    for file_name, file_locations in files.items():
+        if "gcs_file_location" not in file_locations:
+            continue
+        if documents_only and file_locations["file_type"] != "document":
+            continue
 
-    return lst_pdf_files
+        count_tokens = None
+        if hasattr(model, "count_tokens"):
+            count_tokens = lambda file_name=file_name, file_locations=file_locations: model.count_tokens(
+                load_part_from_gcs({file_name: file_locations})
+            ).total_tokens
+        tokens, method = estimate_file_tokens(
+            file_locations, count_tokens, model_name=getattr(model, "_model_name", None)
+        )
+        input_tokens += tokens
+        methods.add(method)
+
+    strategy, reason = choose_strategy(
+        task,
+        input_tokens,
+        section_count=section_count,
+        allow_sections=allow_sections,
+        allow_map_reduce=task == "summary",
+        allow_retrieval=task == "qa",
+    )
+    plan = {
+        "task": task,
+        "input_tokens": input_tokens,
+        "method": methods.pop() if len(methods) == 1 else "count_tokens and local",
+        "strategy": strategy,
+        "reason": reason,
+    }
+    logging.info(f"Pre-flight {task}: {describe_plan(plan)}")
+    return plan
 
 
 def summarize_cim(
     model,
     files: Dict[str, Dict[str, str]],
     temperature: float = 0.7,
+    stream: bool = False,
+    structured: bool = False,
+    strategy: str = None,
+    by_section: bool = False,
+    section: str = None,
+    completed_sections: Dict[str, str] = None,
 ):
     """
     This function uses Gemini to generate a summary of a CIM using an outline template.
     Both the CIM and the template are provided as PDF files, uploaded to GCS.
+    Unless given, the strategy is chosen from the estimated input tokens by plan_request.
     Args:
         model (GemerativeModel): A GenerativeModel object.
         files (dict): A dictionary containing the file locations in GCS.
         temperature (float, optional): The temperature for the model generation. Defaults to 0.7.
+        stream (bool, optional): Whether to stream the response. Defaults to False.
+        structured (bool, optional): Whether to return JSON following SUMMARY_RESPONSE_SCHEMA. Defaults to False.
+        strategy (str, optional): "single_shot", "section_parallel" or "map_reduce". Defaults to choosing automatically.
+        by_section (bool, optional): Whether the sections of the template may be generated in parallel. Defaults to False.
+        section (str, optional): Generate only this section of the template. Defaults to None.
+        completed_sections (dict, optional): Sections kept from a failed attempt, see SectionGenerationError. Defaults to None.
     Returns:
-        A string containing the generated summary.
+        A string containing the generated summary, or an iterator of text chunks if streaming.
     """
 
+    if section is None:
+        sections = template_sections(files)
+        if strategy is None:
+            strategy = plan_request(
+                model,
+                files,
+                "summary",
+                section_count=len(sections),
+                allow_sections=by_section and not stream,
+            )["strategy"]
+        if strategy == MAP_REDUCE:
+            return summarize_cim_map_reduce(
+                model, files, temperature=temperature, stream=stream, structured=structured
+            )
+        # Fall back to a single request if the outline cannot be parsed
+        if strategy == SECTION_PARALLEL and not stream and len(sections) > 1:
+            return summarize_cim_by_section(
+                model,
+                files,
+                sections,
+                temperature=temperature,
+                structured=structured,
+                completed=completed_sections,
+            )
+
     prompt = """
     Fill in the following template with the information in the provided document. Be detailed.
     The output should have detailed metrics and statistics extracted from the document when appropriate. 
@@ -95,18 +565,343 @@ def summarize_cim(
     Include page numbers for references for each section.
     """
 
-    contents = [prompt]
+    contents = [prompt + section_instructions(section)]
 
     # Add the PDF files to the contents
     contents += load_part_from_gcs(files)
 
-    generation_config = {"temperature": temperature}
+    generation_config = create_generation_config(temperature, structured)
 
     # Generate the response
-    response = model.generate_content(
-        contents=contents, generation_config=generation_config
+    return generate_text(
+        model, contents, generation_config, files=files, stream=stream
+    )
+
+
+class SectionGenerationError(Exception):
+    """
+    Raised when sections still fail after retrying.
+    Keeps the completed sections so that only the failed ones need to be generated again.
+    """
+
+    def __init__(self, completed: Dict[str, str], failed: Dict[str, Exception]):
+        self.completed = completed
+        self.failed = failed
+        super().__init__(f"Failed to generate sections: {', '.join(failed)}")
+
+
+def section_instructions(section: str = None, heading_line: bool = False) -> str:
+    """
+    This function creates the prompt instructions for generating a single section.
+    Args:
+        section (str, optional): The title of the section. Defaults to None, for the whole document.
+        heading_line (bool, optional): Whether the output should start with the section title. Defaults to False.
+    Returns:
+        str: The instructions to append to the prompt, or an empty string for the whole document.
+    """
+    if section is None:
+        return ""
+
+    instructions = f"""
+    Only fill out the section "{section}" of the template. Do not include any other section.
+    """
+    if heading_line:
+        instructions += f"""Start the output with the line "{section}".
+    """
+    return instructions
+
+
+def parse_template_outline(doc) -> List[str]:
+    """
+    This function parses the section titles from a template document.
+    The table of contents is used if the document has one. Otherwise, short lines
+    set in a larger font than the body text are taken as section titles, or short
+    bold lines if no line is larger, so bold field labels are not counted as sections.
+    Args:
+        doc (pymupdf.Document): The opened template.
+    Returns:
+        list: The section titles, in document order.
+    """
+    toc = doc.get_toc()
+    if toc:
+        top_level = min(level for level, _, _ in toc)
+        return [title.strip() for level, title, _ in toc if level == top_level]
+
+    # Collect the lines of the template with their font size and weight
+    lines = []
+    for page in doc:
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                spans = [span for span in line["spans"] if span["text"].strip()]
+                if spans:
+                    text = "".join(span["text"] for span in spans).strip()
+                    size = max(span["size"] for span in spans)
+                    bold = all(span["flags"] & 16 for span in spans)
+                    lines.append((text, size, bold))
+    if not lines:
+        return []
+
+    body_size = statistics.median(size for _, size, _ in lines)
+    short_lines = [(text, size, bold) for text, size, bold in lines if len(text) <= 80]
+    titles = [text for text, size, _ in short_lines if size > body_size * 1.15]
+    if not titles:
+        titles = [text for text, _, bold in short_lines if bold]
+    return list(dict.fromkeys(titles))
+
+
+def generate_sections(
+    generate_section,
+    sections: List[str],
+    max_concurrency: int = SECTION_CONCURRENCY,
+    max_attempts: int = SECTION_MAX_ATTEMPTS,
+    completed: Dict[str, str] = None,
+    separator: str = "\n\n",
+) -> str:
+    """
+    This function generates sections in parallel and assembles them in order.
+    A failed section is retried on its own, with a backoff between attempts.
+    Args:
+        generate_section (Callable): Generates the text of a section, given its title.
+        sections (list): The section titles, in document order.
+        max_concurrency (int, optional): The maximum number of parallel requests. Defaults to SECTION_CONCURRENCY.
+        max_attempts (int, optional): The number of attempts per section. Defaults to SECTION_MAX_ATTEMPTS.
+        completed (dict, optional): Sections generated earlier, which are not generated again.
+        separator (str, optional): The text between sections. Defaults to a blank line.
+    Returns:
+        str: The assembled sections.
+    """
+    results = dict(completed or {})
+    failed = {}
+
+    def generate_with_retries(section):
+        for attempt in range(max_attempts):
+            try:
+                return generate_section(section)
+            except Exception as e:
+                logging.warning(f"Error generating section {section} (attempt {attempt + 1}): {e}")
+                if attempt + 1 == max_attempts:
+                    raise
+                time.sleep(2**attempt)
+
+    pending = [section for section in sections if section not in results]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {section: executor.submit(generate_with_retries, section) for section in pending}
+        for section, future in futures.items():
+            try:
+                results[section] = future.result()
+            except Exception as e:
+                failed[section] = e
+
+    if failed:
+        raise SectionGenerationError(results, failed)
+
+    return separator.join(results[section] for section in sections)
+
+
+def summarize_cim_by_section(
+    model,
+    files: Dict[str, Dict[str, str]],
+    sections: List[str],
+    temperature: float = 0.7,
+    structured: bool = False,
+    completed: Dict[str, str] = None,
+):
+    """
+    This function generates each section of the CIM summary in parallel with a focused prompt.
+    Args:
+        model (GemerativeModel): A GenerativeModel object.
+        files (dict): A dictionary containing the file locations in GCS.
+        sections (list): The section titles of the template, in order.
+        temperature (float, optional): The temperature for the model generation. Defaults to 0.7.
+        structured (bool, optional): Whether to return JSON following SUMMARY_RESPONSE_SCHEMA. Defaults to False.
+        completed (dict, optional): Sections generated by a failed attempt, which are not generated again.
+    Returns:
+        A string containing the generated summary.
+    """
+
+    def generate_section(section):
+        return summarize_cim(
+            model, files, temperature=temperature, structured=structured, section=section
+        )
+
+    if not structured:
+        return generate_sections(generate_section, sections, completed=completed)
+
+    # Merge the structured sections into a single summary
+    def generate_structured_section(section):
+        response = generate_section(section)
+        try:
+            return json.dumps(json.loads(response)["sections"])
+        except (json.JSONDecodeError, KeyError, TypeError):
+            fields = [{"field": section, "value": response, "pages": ""}]
+            return json.dumps([{"title": section, "fields": fields}])
+
+    merged = generate_sections(
+        generate_structured_section, sections, completed=completed, separator="\n"
+    )
+    return json.dumps(
+        {"sections": [item for line in merged.split("\n") for item in json.loads(line)]}
+    )
+
+
+def split_page_ranges(page_count: int, pages_per_chunk: int) -> List[Tuple[int, int]]:
+    """
+    This function splits the pages of a document into consecutive ranges.
+    Args:
+        page_count (int): The number of pages.
+        pages_per_chunk (int): The maximum number of pages per range.
+    Returns:
+        list: The (first, last) zero-based page indices of each range, inclusive.
+    """
+    return [
+        (start, min(start + pages_per_chunk, page_count) - 1)
+        for start in range(0, page_count, pages_per_chunk)
+    ]
+
+
+def load_page_range_part(doc, first_page: int, last_page: int):
+    """
+    This function creates a PDF Part containing a range of pages of a document.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        first_page (int): The zero-based index of the first page.
+        last_page (int): The zero-based index of the last page, inclusive.
+    Returns:
+        A Part object with the pages as an inline PDF.
+    """
+    return Part.from_data(
+        data=page_subset_bytes(doc, first_page, last_page), mime_type="application/pdf"
+    )
+
+
+def extract_template_facts(
+    model,
+    template_parts: list,
+    file_name: str,
+    excerpt: Part,
+    page_range: Tuple[int, int],
+    temperature: float = 0.2,
+    files: Dict[str, Dict[str, str]] = None,
+):
+    """
+    This function extracts the facts relevant to the template from a range of pages (map step).
+    Args:
+        model (GemerativeModel): A GenerativeModel object.
+        template_parts (list): The Part objects of the template.
+        file_name (str): The name of the document.
+        excerpt (Part): The pages of the range as an inline PDF, from load_page_range_part.
+        page_range (tuple): The zero-based (first, last) page indices, inclusive.
+        temperature (float, optional): The temperature for the model generation. Defaults to 0.2.
+        files (dict, optional): The files the template parts belong to, used to identify the request.
+    Returns:
+        A string containing the extracted facts with page references.
+    """
+    first_page, last_page = page_range
+
+    prompt = f"""
+    The attached excerpt contains pages {first_page + 1} to {last_page + 1} of the document "{file_name}".
+    The first page of the excerpt is page {first_page + 1} of the original document.
+    Extract every fact, metric and statistic in the excerpt that is relevant to a field of the provided template.
+    List each fact with the template field it belongs to and its original page number.
+    If the excerpt contains nothing relevant, return "No relevant information".
+    """
+
+    contents = [prompt] + template_parts
+    contents.append(
+        describe_segment(file_name, {"first_page": first_page, "last_page": last_page})
+    )
+    contents.append(excerpt)
+
+    generation_config = create_generation_config(temperature)
+
+    # Generate the response
+    return generate_text(model, contents, generation_config, files=files)
+
+
+def summarize_cim_map_reduce(
+    model,
+    files: Dict[str, Dict[str, str]],
+    temperature: float = 0.7,
+    stream: bool = False,
+    structured: bool = False,
+    pages_per_chunk: int = MAP_REDUCE_PAGES_PER_CHUNK,
+    max_concurrency: int = MAP_REDUCE_CONCURRENCY,
+):
+    """
+    This function summarizes very large CIMs with map-reduce.
+    The documents are split into page ranges, the facts relevant to the template are extracted
+    from each range in parallel, and the template is filled in from the merged facts.
+    Args:
+        model (GemerativeModel): A GenerativeModel object.
+        files (dict): A dictionary containing the file locations in GCS and the opened documents.
+        temperature (float, optional): The temperature for the reduce step. Defaults to 0.7.
+        stream (bool, optional): Whether to stream the reduce step. Defaults to False.
+        structured (bool, optional): Whether to return JSON following SUMMARY_RESPONSE_SCHEMA. Defaults to False.
+        pages_per_chunk (int, optional): The number of pages per range. Defaults to MAP_REDUCE_PAGES_PER_CHUNK.
+        max_concurrency (int, optional): The maximum number of parallel requests. Defaults to MAP_REDUCE_CONCURRENCY.
+    Returns:
+        A string containing the generated summary, or an iterator of text chunks if streaming.
+    """
+
+    # Load the templates, which are sent with every request
+    template_parts = [
+        part
+        for file_name, file_locations in files.items()
+        if file_locations.get("file_type") == "template"
+        and "gcs_file_location" in file_locations
+        for part in load_file_part(file_name, file_locations)
+    ]
+
+    # Split the documents into page ranges. The excerpts are cut on the pymupdf thread, one at a time,
+    # as documents are not thread-safe, so the map threads only wait on the model.
+    chunks = run_pdf_work(
+        lambda: [
+            (
+                file_name,
+                load_page_range_part(file_locations["doc"], *page_range),
+                page_range,
+            )
+            for file_name, file_locations in files.items()
+            if file_locations.get("file_type") == "document" and "doc" in file_locations
+            for page_range in split_page_ranges(
+                file_locations["doc"].page_count, pages_per_chunk
+            )
+        ]
+    )
+
+    # Extract the relevant facts from each page range in parallel (map)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        facts = list(
+            executor.map(
+                lambda chunk: extract_template_facts(
+                    model, template_parts, chunk[0], chunk[1], chunk[2], files=files
+                ),
+                chunks,
+            )
+        )
+
+    notes = [
+        f'Facts from "{file_name}", pages {first_page + 1}-{last_page + 1}:\n{chunk_facts}'
+        for (file_name, _, (first_page, last_page)), chunk_facts in zip(chunks, facts)
+    ]
+
+    # Fill in the template from the merged facts (reduce)
+    prompt = """
+    Fill in the provided template using the facts below, which were extracted from the document in page ranges. Be detailed.
+    The output should have detailed metrics and statistics when appropriate.
+    Merge facts about the same field and keep every original page number as a reference.
+    If the information cannot be concluded from the facts, label the field as "Not Available".
+    Include page numbers for references for each section.
+    """
+
+    contents = [prompt] + template_parts + notes
+
+    generation_config = create_generation_config(temperature, structured)
+
+    # Generate the response
+    return generate_text(
+        model, contents, generation_config, files=files, stream=stream
     )
-    return response.text
 
 
 def create_memo(
@@ -115,6 +910,9 @@ def create_memo(
     headings: List[str],
     subheadings: List[str],
     temperature: float = 0.9,
+    by_section: bool = False,
+    section: str = None,
+    strategy: str = None,
 ):
     """
     This function uses Gemini to generate a memo draft based on the provided documents and headings.
@@ -124,10 +922,31 @@ def create_memo(
         headings (list): A list of headings for the memo.
         subheadings (list): A list of subheadings for the memo.
         temperature (float, optional): The temperature for the model generation. Defaults to 0.9.
+        by_section (bool, optional): Whether the headings may be generated in parallel. Defaults to False.
+        section (str, optional): Generate only the section under this heading. Defaults to None.
+        strategy (str, optional): "single_shot" or "section_parallel". Defaults to choosing automatically.
     Returns:
         A string containing the generated memo draft.
     """
 
+    if section is None and strategy is None and by_section:
+        strategy = plan_request(
+            model, files, "memo", documents_only=True, section_count=len(headings)
+        )["strategy"]
+
+    if strategy == SECTION_PARALLEL and section is None and len(headings) > 1:
+        return generate_sections(
+            lambda heading: create_memo(
+                model,
+                files,
+                headings,
+                subheadings,
+                temperature=temperature,
+                section=heading,
+            ),
+            headings,
+        )
+
     prompt = """
     Fill out the Memo Template using the provided documents and knowledge of industry. 
     Be detailed and thorough with the information. Include page numbers for references.
@@ -139,7 +958,7 @@ def create_memo(
 
     # """
 
-    contents = [prompt]
+    contents = [prompt + section_instructions(section, heading_line=True)]
 
     # Add the PDF files to the contents
     contents += load_part_from_gcs(files, documents_only=True)
@@ -155,11 +974,38 @@ def create_memo(
 
     generation_config = {"temperature": temperature}
 
+    # Identify the outline by its content, so an edited outline is not answered from the cache
+    key_files = {
+        **files,
+        "memo_outline": {
+            "gcs_file_location": memo_url,
+            "content_hash": gcs_content_hash(memo_url),
+        },
+    }
+
     # Generate the response
-    response = model.generate_content(
-        contents=contents, generation_config=generation_config
-    )
-    return response.text
+    return generate_text(model, contents, generation_config, files=key_files)
+
+
+def gcs_content_hash(uri: str) -> str:
+    """
+    This function returns the MD5 hash of a file in GCS from its metadata, without downloading it.
+    Args:
+        uri (str): The gs:// URI of the file.
+    Returns:
+        str: The content hash, or the URI with the object generation if the hash is not available.
+    """
+    from utils import get_storage_client
+
+    try:
+        bucket_name, blob_name = uri[len("gs://"):].split("/", 1)
+        blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    except Exception as e:
+        logging.warning(f"Could not read the metadata of {uri}: {e}")
+        blob = None
+    if blob is None:
+        return uri
+    return blob.md5_hash or f"{uri}#{blob.generation}"
 
 
 def format_summary_as_markdown(model, summary: str, temperature: float = 0.7):
@@ -187,23 +1033,87 @@ def format_summary_as_markdown(model, summary: str, temperature: float = 0.7):
     generation_config = {"temperature": temperature}
 
     # Generate the response
-    response = model.generate_content(
-        contents=contents, generation_config=generation_config
-    )
-    return response.text
+    return generate_text(model, contents, generation_config)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    This function shortens a text to an approximate number of tokens.
+    Args:
+        text (str): The text to shorten.
+        max_tokens (int): The maximum number of tokens to keep.
+    Returns:
+        str: The text, cut off with an ellipsis if it was too long.
+    """
+    max_chars = max(max_tokens, 0) * 4
+    if len(text) <= max_chars:
+        return text
+    return text[: max(max_chars - 3, 0)].rstrip() + "..."
 
 
-def format_chat_history(msg_history: List[Dict[str, str]]) -> list[str]:
+def format_chat_history(
+    msg_history: List[Dict[str, str]],
+    token_budget: int = HISTORY_TOKEN_BUDGET,
+    keep_last: int = HISTORY_KEEP_LAST,
+    digest_tokens_per_message: int = 60,
+) -> list[str]:
     """
     Formats the chat history (list of dictionaries) into a list of strings for the LLM.
+    The latest messages are kept verbatim and older messages are folded into a short digest.
+    Full summaries in earlier editor responses are superseded by the latest one and dropped.
+    The formatted history stays within the token budget however long the conversation is.
     Args:
         msg_history (list): A list of dictionaries, where each dictionary has 'role', 'content', and optionally 'display_response' keys.
+        token_budget (int, optional): The approximate maximum number of tokens of the history. Defaults to HISTORY_TOKEN_BUDGET.
+        keep_last (int, optional): The number of latest messages kept verbatim. Defaults to HISTORY_KEEP_LAST.
+        digest_tokens_per_message (int, optional): The number of tokens kept from each older message in the digest. Defaults to 60.
     Returns:
         list[str]: A list of strings representing the conversation turns.
     """
+    # Only the latest summary revision is relevant to the conversation
+    summary_indices = [
+        index
+        for index, msg in enumerate(msg_history)
+        if msg["role"] == "assistant" and "display_response" in msg
+    ]
+    messages = []
+    for index, msg in enumerate(msg_history):
+        content = msg["content"]
+        if index in summary_indices[:-1] and index > 0:
+            content = "[Earlier summary revision, superseded by the latest revision]"
+        messages.append((msg["role"], content))
+
+    split = max(len(messages) - keep_last, 0)
+    older, recent = messages[:split], messages[split:]
+
+    # Keep the latest messages verbatim, shortening the oldest of them if over budget.
+    # Messages with less room left than a digest line are not sent as stubs but left to the digest
+    recent_turns = []
+    remaining = token_budget
+    while recent and (not recent_turns or remaining >= digest_tokens_per_message):
+        role, content = recent.pop()
+        turn = truncate_to_tokens(f"{role}: {content}", remaining)
+        recent_turns.insert(0, turn)
+        remaining -= estimate_tokens(turn)
+    older += recent
+
+    # Fold older messages into a digest with the remaining budget, newest first
+    digest_lines = []
+    for role, content in reversed(older):
+        line = f"- {role}: " + truncate_to_tokens(
+            " ".join(content.split()), digest_tokens_per_message
+        )
+        if estimate_tokens(line) > remaining:
+            break
+        digest_lines.insert(0, line)
+        remaining -= estimate_tokens(line)
+
     formatted_history = []
-    for msg in msg_history:
-        formatted_history.append(f"{msg['role']}: {msg['content']}")
+    if digest_lines:
+        formatted_history.append(
+            "Digest of earlier conversation:\n" + "\n".join(digest_lines)
+        )
+    formatted_history += [turn for turn in recent_turns if turn]
     return formatted_history
 
 
@@ -215,6 +1125,10 @@ def chat_with_model(
     summary: str = None,
     documents_only: bool = False,
     temperature: float = 0.7,
+    stream: bool = False,
+    files_cached: bool = False,
+    structured: bool = False,
+    context_pages: List[str] = None,
 ):
     """
     This function uses Gemini to generate a response to a user prompt based on the provided files and chat history.
@@ -226,12 +1140,23 @@ def chat_with_model(
         msg_history (list): A list of dictionaries representing the chat history.
         summary (str, optional): The previous summary, if using editor chatbot.
         temperature (float, optional): The temperature for the model generation. Defaults to .7.
+        stream (bool, optional): Whether to stream the response. Defaults to False.
+        files_cached (bool, optional): Whether the model already holds the files in a cached context. Defaults to False.
+        structured (bool, optional): Whether to return a summary as JSON following SUMMARY_RESPONSE_SCHEMA. Defaults to False.
+        context_pages (list, optional): Labeled page excerpts to send instead of the full files. Defaults to None.
     Returns:
-       Response: A string containing the generated response.
+       Response: A string containing the generated response, or an iterator of text chunks if streaming.
     """
 
-    # Add the PDF files to the contents
-    contents = load_part_from_gcs(files, documents_only)
+    # Add the retrieved pages, or the PDF files unless they are in the cached context
+    if context_pages is not None:
+        contents = [
+            "Answer using the following pages. Cite the file names and page numbers given in brackets."
+        ] + context_pages
+    elif files_cached:
+        contents = []
+    else:
+        contents = load_part_from_gcs(files, documents_only)
     contents += [user_prompt]
     if summary:
         contents += [summary]
@@ -240,10 +1165,9 @@ def chat_with_model(
     formatted_history = format_chat_history(msg_history)
     contents += formatted_history
 
-    generation_config = {"temperature": temperature}
+    generation_config = create_generation_config(temperature, structured)
 
     # Generate the response
-    response = model.generate_content(
-        contents=contents, generation_config=generation_config
+    return generate_text(
+        model, contents, generation_config, files=files, stream=stream
     )
-    return response.text
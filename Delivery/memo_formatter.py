@@ -1,9 +1,19 @@
 from googleapiclient.discovery import build
+from docx import Document
+from docx.oxml.ns import qn
+from docx.shared import Pt
 import google.auth
 from google.auth import impersonated_credentials
 import streamlit as st
-from typing import List
+from typing import Dict, List
 import os
+import re
+
+# Numbering allowed before a heading title, e.g. "I. " in "I. Executive Summary"
+HEADING_NUMBER_PATTERN = re.compile(r"(?:[IVXLC]+|\d+)\.\s+")
+
+# Headings preceded by a page break, around the Executive Summary
+PAGE_BREAK_HEADINGS = ("Executive Summary", "II. Investment Rationale")
 
 
 def fetch_headers(file: str):
@@ -21,6 +31,77 @@ def fetch_headers(file: str):
     return headers
 
 
+def classify_memo_lines(
+    text: str, heading_titles: List[str], subheading_titles: List[str]
+) -> List[Dict]:
+    """
+    This function classifies each line of the memo as a heading, a subheading or body text.
+    Both memo backends format the lines it returns, so they style the same lines.
+    A heading is a line holding only a heading title, optionally numbered or in markdown
+    emphasis. A subheading is a line starting with a subheading title, followed by its text.
+    Only the first line matching each title is styled.
+    Args:
+        text (str): The memo text.
+        heading_titles (list): A list of heading titles.
+        subheading_titles (list): A list of subheading titles.
+    Returns:
+        list: One dictionary per line with its kind ("heading", "subheading" or "body"), its text,
+            the matched title, and the offsets in the memo text of the line and of the title.
+    """
+    remaining_headings = list(heading_titles)
+    remaining_subheadings = list(subheading_titles)
+    lines = []
+    line_start = 0
+    for line in text.split("\n"):
+        # Skip the indentation and markdown markers before the title
+        content = line.lstrip(" \t#*_")
+        content_start = line_start + len(line) - len(content)
+        content = content.rstrip(" \t*_")
+
+        classified = {
+            "kind": "body",
+            "text": line,
+            "title": None,
+            "start": line_start,
+            "end": line_start + len(line),
+        }
+
+        heading = next(
+            (
+                title
+                for title in remaining_headings
+                if content == title or (
+                    content.endswith(title)
+                    and HEADING_NUMBER_PATTERN.fullmatch(content[: -len(title)])
+                )
+            ),
+            None,
+        )
+        subheading = None
+        if heading is None:
+            subheading = next(
+                (title for title in remaining_subheadings if content.startswith(title)), None
+            )
+
+        if heading is not None:
+            remaining_headings.remove(heading)
+            title_start = content_start + len(content) - len(heading)
+            classified.update(kind="heading", title=heading)
+        elif subheading is not None:
+            remaining_subheadings.remove(subheading)
+            title_start = content_start
+            classified.update(kind="subheading", title=subheading)
+
+        if classified["title"] is not None:
+            classified["title_start"] = title_start
+            classified["title_end"] = title_start + len(classified["title"])
+
+        lines.append(classified)
+        line_start += len(line) + 1
+
+    return lines
+
+
 def read_text(service: object, document_id: str):
     """
     This function reads the text from a Google Doc using the Docs API.
@@ -104,7 +185,10 @@ def format_document(
     subheading_titles: List[str],
 ):
     """
-    This document performs a series of batch updates to the Docs API to format the Google Doc memo.
+    This function formats the Google Doc memo with a single read and a single batch update.
+    All ranges are computed locally from one read of the document. Newlines are inserted
+    in reverse order so the earlier indices do not shift, and the style ranges and page
+    breaks are offset by the newlines inserted before them.
     Args:
         service (googleapiclient.discovery.Resource): The Docs API service.
         document_id (str): The ID of the document to format.
@@ -114,80 +198,79 @@ def format_document(
         None
     """
 
-    # Read the text body of the document
+    # Read the text body of the document once
     text, start_index, end_index = read_text(service, document_id)
 
+    # Find the headings and subheadings in the original text, as the local backend does
+    memo_lines = classify_memo_lines(text, heading_titles, subheading_titles)
+    heading_ranges = [
+        (start_index + line["title_start"], start_index + line["title_end"])
+        for line in memo_lines
+        if line["kind"] == "heading"
+    ]
+    subheading_ranges = [
+        (start_index + line["title_start"], start_index + line["title_end"])
+        for line in memo_lines
+        if line["kind"] == "subheading"
+    ]
+
+    # Newlines are inserted at the end of each subheading
+    newline_indices = sorted({end for _, end in subheading_ranges}, reverse=True)
+
+    def shift(index: int, is_end: bool = False):
+        # Offset an original index by the newlines inserted before it
+        if is_end:
+            return index + sum(1 for newline in newline_indices if newline < index)
+        return index + sum(1 for newline in newline_indices if newline <= index)
+
+    # Insert the newlines from the end of the document backwards
+    requests = [
+        {
+            "insertText": {
+                "location": {"index": newline_index},  # Insert at the end of the subheading
+                "text": "\n",  # Insert a new line
+            }
+        }
+        for newline_index in newline_indices
+    ]
+
     # Set the style of the headings to Heading 1
-    requests = []
-    for title in heading_titles:
-        title_index = text.find(title)  # Find the index of the title in the text
-        if title_index != -1:
-            requests += [
-                {
-                    "updateParagraphStyle": {
-                        "range": {
-                            "startIndex": start_index + title_index,  # Start of the heading
-                            "endIndex": start_index + title_index + len(title),  # End of the heading
-                        },
-                        "paragraphStyle": {
-                            "namedStyleType": "HEADING_1" 
-                        },  # Apply Heading 1 style
-                        "fields": "namedStyleType",
-                    }
+    for heading_start, heading_end in heading_ranges:
+        requests.append(
+            {
+                "updateParagraphStyle": {
+                    "range": {
+                        "startIndex": shift(heading_start),  # Start of the heading
+                        "endIndex": shift(heading_end, is_end=True),  # End of the heading
+                    },
+                    "paragraphStyle": {"namedStyleType": "HEADING_1"},  # Apply Heading 1 style
+                    "fields": "namedStyleType",
                 }
-            ]
-
-    # Execute the requests to update the headings
-    if len(requests) > 0:
-        service.documents().batchUpdate(
-            documentId=document_id, body={"requests": requests}
-        ).execute()
+            }
+        )
 
-    # Set the style of the subheadings
-    for x in range(len(subheading_titles)):
-        subheading = subheading_titles[x]
-        text, start_index, end_index = read_text(
-            service, document_id
-        )  # Read the text body to update indices
-        title_index = text.find(
-            subheading
-        )  # Find the index of the subheading in the text
-
-        if title_index != -1:
-            newline_index = title_index + start_index + len(subheading)
-            request = [
-                {
-                    "insertText": {
-                        "location": {
-                            "index": newline_index  # Insert at the end of the subheading
-                        },
-                        "text": "\n",  #  Insert a new line
+    # Set the style of the subheadings to Heading 3
+    for subheading_start, subheading_end in subheading_ranges:
+        requests.append(
+            {
+                "updateParagraphStyle": {
+                    "range": {
+                        "startIndex": shift(subheading_start),  # Start of the subheading
+                        "endIndex": shift(subheading_end, is_end=True),  # End of the subheading
                     },
-                },
-                {
-                    "updateParagraphStyle": {
-                        "range": {
-                            "startIndex": title_index + start_index,  # Start of the subheading
-                            "endIndex": title_index + start_index + len(subheading),  # End of the subheading
-                        },
-                        "paragraphStyle": {
-                            "namedStyleType": "HEADING_3"
-                        },  # Apply Heading 3 style
-                        "fields": "namedStyleType",
-                    }
-                },
-            ]
-            service.documents().batchUpdate(
-                documentId=document_id, body={"requests": request}
-            ).execute()
+                    "paragraphStyle": {"namedStyleType": "HEADING_3"},  # Apply Heading 3 style
+                    "fields": "namedStyleType",
+                }
+            }
+        )
 
     # Set the font style of the text
-    requests = [
+    requests.append(
         {
             "updateTextStyle": {
                 "range": {
                     "startIndex": start_index,
-                    "endIndex": end_index,
+                    "endIndex": end_index + len(newline_indices),
                 },
                 "textStyle": {
                     "weightedFontFamily": {
@@ -197,45 +280,28 @@ def format_document(
                 "fields": "weightedFontFamily",
             }
         }
+    )
+
+    # Insert page breaks before and after the Executive Summary, from the end backwards
+    page_break_indices = [
+        shift(start_index + line["start"])
+        for line in memo_lines
+        if line["kind"] == "heading" and line["title"] in PAGE_BREAK_HEADINGS and line["start"] > 0
+    ]
+    requests += [
+        {"insertPageBreak": {"location": {"index": page_break_index}}}
+        for page_break_index in sorted(page_break_indices, reverse=True)
     ]
-    service.documents().batchUpdate(documentId=document_id, body={"requests": requests}).execute()
-
-    # Insert page breaks before and after the Executive Summary
-    text, start_index, end_index = read_text(
-        service, document_id
-    )  # Reread text body to update indicies
-    requests = []
-    # Find the start and end index of the Executive Summary
-    exec_start_index = text.find("Executive Summary")
-    exec_end_index = text.find("II. Investment Rationale")
-    if exec_start_index > 0:
-        requests += [
-            {
-                "insertPageBreak": {
-                    "location": {
-                        "index": exec_start_index + start_index
-                    }  # Insert page break before the Executive Summary
-                }
-            }
-        ]
-    if exec_end_index > 0:
-        requests += [
-            {
-                "insertPageBreak": {
-                    "location": {
-                        "index": exec_end_index + start_index
-                    }  # Insert page break after the Executive Summary
-                }
-            }
-        ]
 
-    service.documents().batchUpdate(documentId=document_id, body={"requests": requests}).execute()
+    service.documents().batchUpdate(
+        documentId=document_id, body={"requests": requests}
+    ).execute()
 
     # Insert an image at the beginning of the document
     request = [
         {
             "insertInlineImage": {
-                "location": {"index": 0},
+                "location": {"index": start_index},
                 "uri": "https://drive.google.com/file/d/1VTHdfG2HbGEg08XdRtYpVlAgGWa9m8IG/view?usp=sharing",
                 "objectSize": {
                     "height": {"magnitude": 50, "unit": "PT"},
@@ -245,7 +311,13 @@ def format_document(
         }
     ]
 
-    service.documents().batchUpdate(documentId=document_id, body={"requests": requests}).execute()
+    # The image is sent separately so a failure does not undo the formatting
+    try:
+        service.documents().batchUpdate(
+            documentId=document_id, body={"requests": request}
+        ).execute()
+    except Exception as e:
+        st.write("Problem inserting logo: ", e)
 
     return
 
@@ -275,11 +347,12 @@ def download_from_drive(
     return
 
 
-def format_and_export_memo(filename: str):
+def export_memo_with_google_docs(filename: str, memo_text: str):
     """
-    This function formats the memo document and saves it to a docx file in the session state.
+    This function formats the memo in a Google Doc and exports it to a docx file through Drive.
     Args:
         filename (str): File name to save memo to.
+        memo_text (str): The memo text.
     """
 
     # Set the target scopes
@@ -306,7 +379,7 @@ def format_and_export_memo(filename: str):
 
     # Add memo text to the document
     add_text(
-        service=doc_service, document_id=document_id, text=st.session_state.memo_text
+        service=doc_service, document_id=document_id, text=memo_text
     )
 
     # Fetch the heading and subheading titles
@@ -330,3 +403,89 @@ def format_and_export_memo(filename: str):
     )
 
     return filename
+
+
+def build_memo_docx(
+    filename: str,
+    memo_text: str,
+    heading_titles: List[str],
+    subheading_titles: List[str],
+    logo_path: str = "images/veolia.png",
+):
+    """
+    This function builds the formatted memo as a docx file locally, without the Docs and Drive APIs.
+    It applies the same formatting as format_document: Heading 1 headings, Heading 3 subheadings
+    on their own line, Times New Roman, page breaks around the Executive Summary and the logo.
+    Args:
+        filename (str): File name to save memo to.
+        memo_text (str): The memo text.
+        heading_titles (list): A list of heading titles.
+        subheading_titles (list): A list of subheading titles.
+        logo_path (str, optional): The image inserted at the top of the memo. Defaults to the Veolia logo.
+    """
+
+    document = Document()
+
+    # Set the font of the body and heading styles to Times New Roman
+    for style_name in ["Normal", "Heading 1", "Heading 3"]:
+        font = document.styles[style_name].font
+        font.name = "Times New Roman"
+        font.element.rPr.rFonts.set(qn("w:eastAsia"), "Times New Roman")
+
+    # Insert the logo at the beginning of the document
+    if logo_path and os.path.exists(logo_path):
+        document.add_picture(logo_path, height=Pt(50))
+
+    # Style the same lines as the Docs formatter
+    for line in classify_memo_lines(memo_text, heading_titles, subheading_titles):
+        if line["kind"] == "heading":
+            # Insert page breaks before and after the Executive Summary
+            if line["title"] in PAGE_BREAK_HEADINGS and line["start"] > 0:
+                document.add_page_break()
+            document.add_paragraph(line["text"].strip(" \t#*_"), style="Heading 1")
+        elif line["kind"] == "subheading":
+            # Place the subheading on its own line, followed by its text
+            document.add_paragraph(line["title"], style="Heading 3")
+            remainder = memo_text[line["title_end"] : line["end"]].strip(" \t*_")
+            if remainder:
+                document.add_paragraph(remainder)
+        else:
+            document.add_paragraph(line["text"])
+
+    document.save(filename)
+
+    return
+
+
+def format_and_export_memo(filename: str, memo_text: str = None, backend: str = None):
+    """
+    This function formats the memo document and saves it to a docx file in the session state.
+    Args:
+        filename (str): File name to save memo to.
+        memo_text (str, optional): The memo text. Defaults to the memo text in the session state.
+        backend (str, optional): "local" to build the docx in-process, or "google_docs" to format
+            it with the Docs API. Defaults to the MEMO_BACKEND environment variable, or "local".
+    """
+
+    if memo_text is None:
+        memo_text = st.session_state.memo_text
+
+    if backend is None:
+        backend = os.getenv("MEMO_BACKEND") or "local"
+
+    if backend == "google_docs":
+        return export_memo_with_google_docs(filename=filename, memo_text=memo_text)
+
+    # Fetch the heading and subheading titles
+    heading_titles = fetch_headers("memo_elements/headings.txt")
+    subheading_titles = fetch_headers("memo_elements/subheadings.txt")
+
+    # Build the formatted document locally
+    build_memo_docx(
+        filename=filename,
+        memo_text=memo_text,
+        heading_titles=heading_titles,
+        subheading_titles=subheading_titles,
+    )
+
+    return filename
@@ -0,0 +1,178 @@
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, Tuple
+from llm_manager import SYSTEM_INSTRUCTIONS, create_client
+
+
+class RegisteredModel:
+    """
+    A long-lived model client handed out by the registry.
+    Behaves like the wrapped client and counts its requests, errors and latency.
+    """
+
+    def __init__(self, model, model_name: str, chatbot_function: str = None, task: str = None):
+        """
+        Args:
+            model: The RoutedModel, GenerativeModel or SecureGPTModel to wrap.
+            model_name (str): The name of the model.
+            chatbot_function (str, optional): The chatbot function of the client.
+            task (str, optional): The task the client is routed for.
+        """
+        self.model = model
+        self.model_name = model_name
+        self.chatbot_function = chatbot_function
+        self.task = task
+        self.created_at = time.time()
+        self.checkouts = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # The wrapped client itself and special methods are never delegated, so copying or
+        # unpickling a client before model is set raises AttributeError instead of recursing
+        if name == "model" or name.startswith("__"):
+            raise AttributeError(name)
+        # Delegate everything else, e.g. the model name used in the response cache keys
+        return getattr(self.model, name)
+
+    def generate_content(self, *args, **kwargs):
+        """
+        This function calls generate_content on the wrapped client and records the usage.
+        For streamed responses, the latency is the time to the first response.
+        """
+        start = time.monotonic()
+        try:
+            return self.model.generate_content(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.requests += 1
+                self.total_latency += time.monotonic() - start
+
+    def stats(self) -> dict:
+        """
+        This function returns the usage counters of the client.
+        """
+        with self._lock:
+            stats = {
+                "model_name": self.model_name,
+                "chatbot_function": self.chatbot_function,
+                "task": self.task,
+                "checkouts": self.checkouts,
+                "requests": self.requests,
+                "errors": self.errors,
+                "average_latency": self.total_latency / self.requests if self.requests else 0.0,
+            }
+        # Add the fallback and hedging counters of routed clients
+        if hasattr(self.model, "route_stats"):
+            stats["routing"] = self.model.route_stats()
+        return stats
+
+
+class ModelRegistry:
+    """
+    A process-wide, thread-safe registry of model clients.
+    One client is created per (model name, system instruction, generation defaults, task)
+    and shared by every rerun and session, so clients are not rebuilt on each rerun.
+    """
+
+    def __init__(self, create_model: Callable = create_client):
+        """
+        Args:
+            create_model (Callable, optional): Factory creating a client. Defaults to create_client.
+        """
+        self.create_model = create_model
+        self.clients: Dict[Tuple, RegisteredModel] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        model_name: str, chatbot_function: str = None, generation_config: dict = None, task: str = None
+    ):
+        """
+        This function builds the registry key for a model, system instruction, generation defaults and task.
+        Returns:
+            tuple: The registry key.
+        """
+        return (
+            model_name,
+            SYSTEM_INSTRUCTIONS.get(chatbot_function),
+            json.dumps(generation_config or {}, sort_keys=True, default=str),
+            task or chatbot_function,
+        )
+
+    def get(
+        self, model_name: str, chatbot_function: str = None, generation_config: dict = None, task: str = None
+    ):
+        """
+        This function returns the shared client for a model, creating it on first use.
+        Args:
+            model_name (str): The name of the model to use.
+            chatbot_function (str, optional): The chatbot function to use. Specifies system instructions. Defaults to None.
+            generation_config (dict, optional): The generation defaults of the client. Defaults to None.
+            task (str, optional): The task the requests are routed for. Defaults to the chatbot function.
+        Returns:
+            RegisteredModel: The shared client.
+        """
+        client = self._get_or_create(model_name, chatbot_function, generation_config, task)
+        with client._lock:
+            client.checkouts += 1
+        return client
+
+    def _get_or_create(
+        self, model_name: str, chatbot_function: str = None, generation_config: dict = None, task: str = None
+    ):
+        """
+        This function returns the client for a key, creating it under the lock so it is created once.
+        """
+        key = self.make_key(model_name, chatbot_function, generation_config, task)
+        with self._lock:
+            if key not in self.clients:
+                model = self.create_model(
+                    model_name=model_name,
+                    chatbot_function=chatbot_function,
+                    generation_config=generation_config,
+                    task=task,
+                )
+                self.clients[key] = RegisteredModel(
+                    model, model_name, chatbot_function, task or chatbot_function
+                )
+            return self.clients[key]
+
+    def warm(self, model_names: Iterable[str], tasks: Iterable[str] = (None,)):
+        """
+        This function creates the clients the app will use ahead of the first request.
+        Clients that cannot be created are skipped and created again on first use.
+        Args:
+            model_names (list): The names of the models to create.
+            tasks (list, optional): The tasks to create each model for. "editor" and "qa" are chatbot functions.
+        """
+        for model_name in model_names:
+            for task in tasks:
+                chatbot_function = task if task in SYSTEM_INSTRUCTIONS else None
+                try:
+                    client = self._get_or_create(model_name, chatbot_function, task=task)
+                    # Routed clients create their models on first use, so create the first choice now
+                    if hasattr(client.model, "warm"):
+                        client.model.warm()
+                except Exception as e:
+                    logging.warning(f"Could not warm client {model_name} ({task}): {e}")
+
+    def stats(self) -> list:
+        """
+        This function returns the usage counters of every client.
+        """
+        with self._lock:
+            clients = list(self.clients.values())
+        return [client.stats() for client in clients]
+
+
+# Shared registry for all sessions of the app
+model_registry = ModelRegistry()
@@ -0,0 +1,354 @@
+import logging
+import os
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from secure_gpt_api import SECURE_GPT_MODEL, SecureGPTError
+
+# Relative cost and latency of the models, used to order them by policy
+MODEL_PROFILES = {
+    "gemini-1.5-flash": {"cost": 1, "latency": 1},
+    "gemini-2.0-flash": {"cost": 1.3, "latency": 1},
+    "gemini-1.5-pro": {"cost": 17, "latency": 3},
+    "Secure GPT": {"cost": 10, "latency": 4},
+}
+
+# Models tried after the selected model when a request fails with a 429 or 5xx error.
+# Only models of the selected model's provider are used, so Secure GPT has no fallback by default.
+DEFAULT_FALLBACK_MODELS = ("gemini-2.0-flash", "gemini-1.5-flash")
+
+# Routing policy of each task: "selected" tries the selected model first,
+# "latency" the fastest model and "cost" the cheapest model
+DEFAULT_TASK_POLICIES = {
+    "summary": "selected",
+    "memo": "selected",
+    "markdown": "cost",
+    "qa": "selected",
+    "editor": "selected",
+}
+
+# Tasks whose requests are hedged with a duplicate after the p95 latency
+DEFAULT_HEDGED_TASKS = ("qa",)
+
+# Hedge timeout until enough latencies are recorded, and the number of latencies kept
+DEFAULT_HEDGE_TIMEOUT = 10.0
+
+# Once hedged, a request is given up after this many hedge timeouts and falls back to the next model
+HEDGE_DEADLINE_FACTOR = 6
+MIN_LATENCY_SAMPLES = 20
+MAX_LATENCY_SAMPLES = 200
+
+# Threads running the hedged requests
+hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+def router_enabled() -> bool:
+    """
+    This function returns whether requests are routed. Set MODEL_ROUTER_ENABLED=False to disable routing.
+    """
+    return os.getenv("MODEL_ROUTER_ENABLED", "True").lower() != "false"
+
+
+def parse_setting(value: str) -> Dict[str, str]:
+    """
+    This function parses a setting such as "qa=latency,markdown=cost".
+    """
+    return dict(
+        item.split("=", 1) for item in (value or "").replace(" ", "").split(",") if "=" in item
+    )
+
+
+def task_policy(task: str) -> str:
+    """
+    This function returns the routing policy of a task.
+    Set MODEL_ROUTER_POLICIES, e.g. "qa=latency,markdown=cost", to override the defaults.
+    """
+    policies = {**DEFAULT_TASK_POLICIES, **parse_setting(os.getenv("MODEL_ROUTER_POLICIES"))}
+    return policies.get(task, "selected")
+
+
+def hedged_tasks() -> List[str]:
+    """
+    This function returns the tasks whose requests are hedged.
+    Set MODEL_ROUTER_HEDGED_TASKS, e.g. "qa,editor", or to an empty value to disable hedging.
+    """
+    value = os.getenv("MODEL_ROUTER_HEDGED_TASKS")
+    if value is None:
+        return list(DEFAULT_HEDGED_TASKS)
+    return [task.strip() for task in value.split(",") if task.strip()]
+
+
+def model_provider(model_name: str) -> str:
+    """
+    This function returns the provider serving a model, "secure_gpt" or "vertex".
+    """
+    return "secure_gpt" if model_name == SECURE_GPT_MODEL else "vertex"
+
+
+def cross_provider_fallbacks() -> bool:
+    """
+    This function returns whether requests may fall back to a model of another provider,
+    e.g. from Secure GPT to Gemini. Set MODEL_ROUTER_CROSS_PROVIDER=True to allow it.
+    """
+    return os.getenv("MODEL_ROUTER_CROSS_PROVIDER", "False").lower() == "true"
+
+
+def route_models(task: str, model_name: str) -> List[str]:
+    """
+    This function orders the models a task is sent to, first choice first.
+    Documents are only sent to the provider of the selected model unless cross-provider fallbacks are allowed.
+    Args:
+        task (str): The task, "summary", "memo", "markdown", "qa" or "editor".
+        model_name (str): The selected model.
+    Returns:
+        list: The model names, without duplicates.
+    """
+    fallbacks = os.getenv("MODEL_ROUTER_FALLBACKS")
+    fallbacks = [name.strip() for name in fallbacks.split(",")] if fallbacks else list(DEFAULT_FALLBACK_MODELS)
+
+    if not cross_provider_fallbacks():
+        fallbacks = [name for name in fallbacks if model_provider(name) == model_provider(model_name)]
+
+    policy = task_policy(task)
+    candidates = [model_name] + [name for name in fallbacks if name != model_name]
+    if policy in ("cost", "latency"):
+        candidates.sort(key=lambda name: MODEL_PROFILES.get(name, {}).get(policy, float("inf")))
+    return list(dict.fromkeys(candidates))
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    This function checks whether a failed request should be sent to another model: 429, 5xx and connection errors.
+    """
+    if isinstance(error, SecureGPTError) and error.status_code is None:
+        return True
+    code = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(code, int):
+        return code == 429 or code >= 500
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class RoutedModel:
+    """
+    A model client that routes the requests of a task to an ordered list of models.
+    Requests failing with a 429 or 5xx error are retried on the next model, and hedged
+    requests send a duplicate once the first response takes longer than the p95 latency.
+    """
+
+    def __init__(
+        self,
+        task: str,
+        model_names: List[str],
+        create_model: Callable,
+        hedge: bool = False,
+        latencies: deque = None,
+    ):
+        """
+        Args:
+            task (str): The task of the requests.
+            model_names (list): The models to try, first choice first.
+            create_model (Callable): Factory creating the client of a model from its name.
+            hedge (bool, optional): Whether to hedge the requests. Defaults to False.
+            latencies (deque, optional): Latencies shared with another client of the task. Defaults to a new window.
+        """
+        self.task = task
+        self.model_names = model_names
+        self.create_model = create_model
+        self.hedge = hedge
+        self.models = {}
+        self.latencies = latencies if latencies is not None else deque(maxlen=MAX_LATENCY_SAMPLES)
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def model(self, model_name: str):
+        """
+        This function returns the client of a model, creating it on first use.
+        """
+        with self._lock:
+            if model_name not in self.models:
+                self.models[model_name] = self.create_model(model_name)
+            return self.models[model_name]
+
+    def warm(self):
+        """
+        This function creates the client of the first choice ahead of the first request.
+        """
+        self.model(self.model_names[0])
+
+    def __getattr__(self, name):
+        # Delegate everything else to the first choice, e.g. the names used in the response cache keys
+        if name in ("model_names", "models", "create_model", "latencies", "_lock"):
+            raise AttributeError(name)
+        return getattr(self.model(self.model_names[0]), name)
+
+    def unhedged(self):
+        """
+        This function returns a client routing like this one without hedging, e.g. to fall back to
+        from a client that hedges itself. It shares the model clients and latencies of this client.
+        """
+        return RoutedModel(self.task, self.model_names, self.model, latencies=self.latencies)
+
+    def hedge_timeout(self) -> float:
+        """
+        This function returns the p95 of the recent latencies, or the default until enough are recorded.
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_HEDGE_TIMEOUT
+        return statistics.quantiles(latencies, n=20)[18]
+
+    def route_stats(self) -> dict:
+        """
+        This function returns the routing counters of the client.
+        """
+        return {
+            "task": self.task,
+            "models": self.model_names,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "p95_latency": self.hedge_timeout(),
+        }
+
+    def generate_content(self, contents, generation_config: dict = None, stream: bool = False):
+        """
+        This function sends a request to the first model that does not fail with a retryable error.
+        Streamed requests are checked up to their first chunk, so a failure can still fall back.
+        Args:
+            contents (list): The contents to send to the model.
+            generation_config (dict, optional): The generation config.
+            stream (bool, optional): Whether to stream the response. Defaults to False.
+        Returns:
+            The response, or an iterator of response chunks if streaming.
+        """
+        for index, model_name in enumerate(self.model_names):
+            try:
+                if self.hedge:
+                    return self._generate_hedged(model_name, contents, generation_config, stream)
+                return self._generate(model_name, contents, generation_config, stream)
+            except Exception as e:
+                if not is_retryable(e) or index == len(self.model_names) - 1:
+                    raise
+                with self._lock:
+                    self.fallbacks += 1
+                logging.warning(
+                    f"{self.task} request to {model_name} failed ({e}), "
+                    f"falling back to {self.model_names[index + 1]}"
+                )
+
+    def _generate(self, model_name: str, contents, generation_config: dict, stream: bool):
+        """
+        This function sends a request to a model and records its latency, to the first chunk if streaming.
+        """
+        start = time.monotonic()
+        response = self.model(model_name).generate_content(
+            contents=contents, generation_config=generation_config, stream=stream
+        )
+        if stream:
+            response = iter(response)
+            # Raise errors of the request here rather than while the caller reads the stream
+            first_chunk = next(response, None)
+            response = prepend_chunk(first_chunk, response)
+        with self._lock:
+            self.latencies.append(time.monotonic() - start)
+        return response
+
+    def _generate_hedged(self, model_name: str, contents, generation_config: dict, stream: bool):
+        """
+        This function sends a request, and a duplicate if no response arrives within the p95 latency.
+        The first response wins. The other request is left to finish in the background.
+        If neither request returns within HEDGE_DEADLINE_FACTOR hedge timeouts, a TimeoutError is raised,
+        which falls back to the next model.
+        """
+        results = queue.Queue()
+        hedge_timeout = self.hedge_timeout()
+
+        def attempt(attempt_index):
+            try:
+                results.put((attempt_index, self._generate(model_name, contents, generation_config, stream), None))
+            except Exception as e:
+                results.put((attempt_index, None, e))
+
+        hedge_executor.submit(attempt, 0)
+        attempts = 1
+        try:
+            result = results.get(timeout=hedge_timeout)
+        except queue.Empty:
+            with self._lock:
+                self.hedges += 1
+            logging.info(f"Hedging slow {self.task} request to {model_name}")
+            hedge_executor.submit(attempt, 1)
+            attempts = 2
+            result = None
+
+        # Bound the wait, so a stuck request does not block the caller forever
+        deadline = time.monotonic() + hedge_timeout * HEDGE_DEADLINE_FACTOR
+
+        def wait_for_result():
+            try:
+                return results.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise TimeoutError(
+                    f"{self.task} request to {model_name} timed out after hedging"
+                ) from None
+
+        if result is None:
+            result = wait_for_result()
+
+        # Wait for the other request if the first one to return failed
+        attempt_index, response, error = result
+        if error is not None and attempts == 2:
+            attempt_index, response, error = wait_for_result()
+        if error is not None:
+            raise error
+        if attempt_index == 1:
+            with self._lock:
+                self.hedge_wins += 1
+        return response
+
+
+class PrependedContentsModel:
+    """
+    A model client that sends the same contents ahead of every request,
+    e.g. the files of a cached context when falling back to a model without the cache.
+    """
+
+    def __init__(self, model, contents_factory: Callable):
+        """
+        Args:
+            model: The client to send the requests to.
+            contents_factory (Callable): Returns the contents to send ahead of the request.
+        """
+        self.model = model
+        self.contents_factory = contents_factory
+
+    def __getattr__(self, name):
+        if name in ("model", "contents_factory"):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def generate_content(self, contents, generation_config: dict = None, stream: bool = False):
+        """
+        This function sends the request with the prepended contents.
+        """
+        return self.model.generate_content(
+            contents=list(self.contents_factory()) + list(contents),
+            generation_config=generation_config,
+            stream=stream,
+        )
+
+
+def prepend_chunk(first_chunk, chunks):
+    """
+    This function yields a chunk already read from a stream, then the rest of the stream.
+    """
+    if first_chunk is not None:
+        yield first_chunk
+    yield from chunks
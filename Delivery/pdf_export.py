@@ -0,0 +1,189 @@
+import html
+import re
+from typing import List
+import pymupdf
+
+# Page layout and styles of the exported PDFs
+PAGE_SIZE = "letter"
+PAGE_MARGIN = 43  # 1.5cm in points
+PDF_CSS = """
+body { font-family: serif; font-size: 10pt; }
+h1 { font-size: 18pt; margin-top: 12pt; }
+h2 { font-size: 15pt; margin-top: 10pt; }
+h3 { font-size: 12pt; margin-top: 8pt; }
+h4, h5, h6 { font-size: 11pt; }
+p { margin-bottom: 4pt; }
+table { border-collapse: collapse; width: 100%; margin-bottom: 8pt; }
+th, td { border: 1px solid #777; padding: 3pt; text-align: left; vertical-align: top; }
+th { background-color: #e8e8e8; font-weight: bold; }
+"""
+
+TABLE_SEPARATOR = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+
+
+def format_inline(text: str) -> str:
+    """
+    This function converts the inline markdown of a line to HTML.
+    Args:
+        text (str): The markdown text.
+    Returns:
+        str: The HTML text, with bold, italic and code spans and line breaks.
+    """
+    text = html.escape(text, quote=False)
+    # Keep the entities and line breaks written by the summary renderer and the model
+    text = text.replace("&amp;#124;", "&#124;")
+    text = re.sub(r"&lt;br\s*/?&gt;", "<br/>", text)
+    text = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text)
+    text = re.sub(r"(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?![\w*])", r"<i>\1</i>", text)
+    text = re.sub(r"`(.+?)`", r"<code>\1</code>", text)
+    return text
+
+
+def split_table_row(line: str) -> List[str]:
+    """
+    This function splits a markdown table row into its cells.
+    """
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+
+def markdown_to_html(markdown_text: str) -> str:
+    """
+    This function converts markdown to HTML for the PDF layout.
+    Supports the headings, tables, lists and paragraphs used in the summaries.
+    Args:
+        markdown_text (str): The markdown text.
+    Returns:
+        str: The HTML document body.
+    """
+    lines = markdown_text.split("\n")
+    parts = []
+    paragraph = []
+    index = 0
+
+    def flush_paragraph():
+        if paragraph:
+            parts.append(f"<p>{'<br/>'.join(format_inline(line) for line in paragraph)}</p>")
+            paragraph.clear()
+
+    while index < len(lines):
+        line = lines[index].rstrip()
+        stripped = line.strip()
+
+        # Headings
+        heading = re.match(r"^(#{1,6})\s+(.*)$", stripped)
+        if heading:
+            flush_paragraph()
+            level = len(heading.group(1))
+            parts.append(f"<h{level}>{format_inline(heading.group(2))}</h{level}>")
+            index += 1
+            continue
+
+        # Tables, with a header row followed by a separator row
+        if (
+            stripped.startswith("|")
+            and index + 1 < len(lines)
+            and TABLE_SEPARATOR.match(lines[index + 1])
+        ):
+            flush_paragraph()
+            header = split_table_row(stripped)
+            rows = []
+            index += 2
+            while index < len(lines) and lines[index].strip().startswith("|"):
+                rows.append(split_table_row(lines[index]))
+                index += 1
+            table = ["<table>", "<tr>"]
+            table += [f"<th>{format_inline(cell)}</th>" for cell in header]
+            table.append("</tr>")
+            for row in rows:
+                table.append("<tr>")
+                table += [f"<td>{format_inline(cell)}</td>" for cell in row]
+                table.append("</tr>")
+            table.append("</table>")
+            parts.append("".join(table))
+            continue
+
+        # Bulleted and numbered lists
+        list_item = re.match(r"^([-*+]|\d+[.)])\s+(.*)$", stripped)
+        if list_item:
+            flush_paragraph()
+            tag = "ol" if list_item.group(1)[0].isdigit() else "ul"
+            items = []
+            while index < len(lines):
+                list_item = re.match(r"^([-*+]|\d+[.)])\s+(.*)$", lines[index].strip())
+                if not list_item:
+                    break
+                items.append(f"<li>{format_inline(list_item.group(2))}</li>")
+                index += 1
+            parts.append(f"<{tag}>{''.join(items)}</{tag}>")
+            continue
+
+        # Paragraphs are separated by blank lines
+        if stripped:
+            paragraph.append(stripped)
+        else:
+            flush_paragraph()
+        index += 1
+
+    flush_paragraph()
+    return "\n".join(parts)
+
+
+def memo_to_html(memo_text: str, heading_titles: List[str], subheading_titles: List[str]) -> str:
+    """
+    This function converts the memo text to HTML, styling headings and subheadings as in the docx memo.
+    Args:
+        memo_text (str): The memo text.
+        heading_titles (list): A list of heading titles.
+        subheading_titles (list): A list of subheading titles.
+    Returns:
+        str: The HTML document body.
+    """
+    parts = []
+    for line in memo_text.split("\n"):
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        heading = next((title for title in heading_titles if title in stripped), None)
+        subheading = next((title for title in subheading_titles if stripped.startswith(title)), None)
+        if heading is not None:
+            parts.append(f"<h1>{format_inline(stripped)}</h1>")
+        elif subheading is not None:
+            parts.append(f"<h3>{format_inline(subheading)}</h3>")
+            remainder = stripped[len(subheading):].strip()
+            if remainder:
+                parts.append(f"<p>{format_inline(remainder)}</p>")
+        else:
+            parts.append(f"<p>{format_inline(stripped)}</p>")
+    return "\n".join(parts)
+
+
+def html_to_pdf(body_html: str, output_path: str):
+    """
+    This function lays out HTML into a PDF file in-process with pymupdf.
+    Args:
+        body_html (str): The HTML document body.
+        output_path (str): The path to the output pdf file.
+    """
+    story = pymupdf.Story(html=body_html, user_css=PDF_CSS)
+    mediabox = pymupdf.paper_rect(PAGE_SIZE)
+    where = mediabox + (PAGE_MARGIN, PAGE_MARGIN, -PAGE_MARGIN, -PAGE_MARGIN)
+
+    writer = pymupdf.DocumentWriter(output_path)
+    more = True
+    while more:
+        device = writer.begin_page(mediabox)
+        more, _ = story.place(where)
+        story.draw(device)
+        writer.end_page()
+    writer.close()
+
+
+def markdown_to_pdf(markdown_text: str, output_path: str):
+    """
+    This function renders markdown straight to a PDF file, keeping headings and tables.
+    Args:
+        markdown_text (str): The markdown text.
+        output_path (str): The path to the output pdf file.
+    """
+    html_to_pdf(markdown_to_html(markdown_text), output_path)
@@ -0,0 +1,114 @@
+import logging
+import os
+import re
+import time
+from typing import Dict, Set, Tuple
+import pymupdf
+
+# Images above this resolution are downsampled to it, in dots per inch
+DEFAULT_DPI_CAP = 150
+
+# JPEG quality of the recompressed images
+DEFAULT_IMAGE_QUALITY = 75
+
+
+def slimming_enabled() -> bool:
+    """
+    This function returns whether PDFs are optimized before upload by default.
+    Set PDF_SLIM_ENABLED=False to upload the files as received.
+    """
+    return os.getenv("PDF_SLIM_ENABLED", "True").lower() != "false"
+
+
+def slimming_options() -> Dict:
+    """
+    This function returns the arguments of slim_pdf configured by the environment.
+    Set PDF_SLIM_DPI and PDF_SLIM_QUALITY to change the image resolution cap and JPEG quality.
+    """
+    return {
+        "dpi_cap": int(os.getenv("PDF_SLIM_DPI") or DEFAULT_DPI_CAP),
+        "quality": int(os.getenv("PDF_SLIM_QUALITY") or DEFAULT_IMAGE_QUALITY),
+    }
+
+
+def parse_page_ranges(text: str, page_count: int) -> Set[int]:
+    """
+    This function parses page ranges such as "1-3, 10, 140-150".
+    Args:
+        text (str): The one-based page ranges, separated by commas.
+        page_count (int): The number of pages of the document. Pages beyond it are ignored.
+    Returns:
+        set: The zero-based indices of the pages.
+    """
+    pages = set()
+    for match in re.finditer(r"(\d+)\s*(?:-\s*(\d+))?", text or ""):
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        pages.update(page - 1 for page in range(first, last + 1) if 1 <= page <= page_count)
+    return pages
+
+
+def blank_pages(doc, pages: Set[int]):
+    """
+    This function replaces pages with placeholder pages, so the other pages keep their page numbers.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        pages (set): The zero-based indices of the pages to replace.
+    """
+    for page_index in sorted(pages):
+        rect = doc[page_index].rect
+        doc.delete_page(page_index)
+        page = doc.new_page(pno=page_index, width=rect.width, height=rect.height)
+        page.insert_text((72, 72), f"Page {page_index + 1} was excluded before upload.")
+
+
+def slim_pdf(
+    data: bytes,
+    dpi_cap: int = DEFAULT_DPI_CAP,
+    quality: int = DEFAULT_IMAGE_QUALITY,
+    exclude_pages: str = None,
+) -> Tuple[bytes, Dict]:
+    """
+    This function reduces the size of a PDF before it is uploaded and sent to the model.
+    Embedded images above the DPI cap are downsampled and recompressed, unused objects are
+    removed, streams are deflated, and excluded pages are replaced with placeholders.
+    Args:
+        data (bytes): The PDF file contents.
+        dpi_cap (int, optional): The maximum resolution of the images. Defaults to DEFAULT_DPI_CAP.
+        quality (int, optional): The JPEG quality of the recompressed images. Defaults to DEFAULT_IMAGE_QUALITY.
+        exclude_pages (str, optional): One-based page ranges to drop, e.g. "1-3, 140-150". Defaults to None.
+    Returns:
+        tuple: The optimized file contents, or the original if they are not smaller, and a report
+        with the original and optimized sizes, the bytes saved and the excluded pages.
+    """
+    start = time.monotonic()
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        excluded = parse_page_ranges(exclude_pages, doc.page_count)
+        blank_pages(doc, excluded)
+        doc.rewrite_images(dpi_threshold=dpi_cap + 1, dpi_target=dpi_cap, quality=quality)
+        # Keep the trailer ID, so the same upload always yields the same bytes and content hash
+        slimmed = doc.tobytes(
+            garbage=3,
+            deflate=True,
+            deflate_images=True,
+            deflate_fonts=True,
+            use_objstms=1,
+            no_new_id=True,
+        )
+
+    # Keep the original if nothing was gained
+    if len(slimmed) >= len(data) and not excluded:
+        slimmed = data
+
+    report = {
+        "original_bytes": len(data),
+        "slimmed_bytes": len(slimmed),
+        "saved_bytes": len(data) - len(slimmed),
+        "excluded_pages": len(excluded),
+        "seconds": time.monotonic() - start,
+    }
+    logging.info(
+        f"Optimized PDF: {report['original_bytes'] / 1e6:.1f} MB -> {report['slimmed_bytes'] / 1e6:.1f} MB "
+        f"in {report['seconds']:.1f}s, {report['excluded_pages']} pages excluded"
+    )
+    return slimmed, report
@@ -0,0 +1,43 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# pymupdf is not thread-safe and holds the GIL, so all of its work runs on this one thread
+_pdf_thread = threading.local()
+
+
+def _mark_pdf_thread():
+    _pdf_thread.active = True
+
+
+pdf_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="pymupdf", initializer=_mark_pdf_thread
+)
+
+
+def on_pdf_thread() -> bool:
+    """
+    This function returns whether the current thread is the pymupdf thread.
+    """
+    return getattr(_pdf_thread, "active", False)
+
+
+def submit_pdf_work(func: Callable, *args, **kwargs) -> Future:
+    """
+    This function queues pymupdf work on the pymupdf thread without waiting for it, e.g. page prefetching.
+    Returns:
+        Future: Resolves to the result of the work.
+    """
+    return pdf_executor.submit(func, *args, **kwargs)
+
+
+def run_pdf_work(func: Callable, *args, **kwargs):
+    """
+    This function runs pymupdf work on the pymupdf thread and waits for its result.
+    Work already running on the pymupdf thread is run inline, so nested calls do not deadlock.
+    Returns:
+        The return value of the work. Raises its exception if it failed.
+    """
+    if on_pdf_thread():
+        return func(*args, **kwargs)
+    return pdf_executor.submit(func, *args, **kwargs).result()
@@ -0,0 +1,155 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # Allows the pipeline to run outside of a Streamlit session
+    add_script_run_ctx, get_script_run_ctx = None, None
+
+
+class Pipeline:
+    """
+    A small dependency-aware scheduler for the generation stages of the app.
+    Each stage is a function that receives the results of the stages it depends on,
+    in the order they were listed. Stages are submitted to a thread pool as soon as
+    all of their dependencies have finished, so independent chains run in parallel.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """
+        Args:
+            max_workers (int, optional): The number of threads used to run stages. Defaults to 4.
+        """
+        self.max_workers = max_workers
+        self.stages: Dict[str, Tuple[Callable, Tuple[str, ...]]] = {}
+        self.futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def add_stage(self, name: str, func: Callable, depends_on: List[str] = ()):
+        """
+        This function registers a stage in the pipeline.
+        Args:
+            name (str): The unique name of the stage.
+            func (Callable): The function to run. Called with the results of the dependencies.
+            depends_on (list, optional): The names of the stages this stage depends on.
+        Returns:
+            The pipeline, so calls can be chained.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already defined.")
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'.")
+
+        self.stages[name] = (func, tuple(depends_on))
+        self.futures[name] = Future()
+        return self
+
+    def run(self):
+        """
+        This function starts every stage whose dependencies are satisfied.
+        The remaining stages are started as their dependencies complete.
+        Returns:
+            dict: A dictionary mapping stage names to their futures.
+        """
+        # Attach the Streamlit script context so stages can read the session state
+        ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+        def attach_context():
+            if ctx is not None:
+                add_script_run_ctx(threading.current_thread(), ctx)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="pipeline",
+            initializer=attach_context,
+        )
+
+        for name, (_, depends_on) in self.stages.items():
+            if not depends_on:
+                self._submit(name)
+
+        return self.futures
+
+    def result(self, name: str, timeout: float = None):
+        """
+        This function waits for a stage to complete and returns its result.
+        Args:
+            name (str): The name of the stage.
+            timeout (float, optional): The number of seconds to wait. Defaults to no limit.
+        Returns:
+            The return value of the stage. Raises the stage's exception if it failed.
+        """
+        return self.futures[name].result(timeout=timeout)
+
+    def done(self, name: str = None):
+        """
+        This function checks whether a stage, or the whole pipeline, has finished.
+        Args:
+            name (str, optional): The name of the stage. Defaults to checking every stage.
+        Returns:
+            bool: True if finished.
+        """
+        if name is not None:
+            return self.futures[name].done()
+        return all(future.done() for future in self.futures.values())
+
+    def shutdown(self, wait: bool = False):
+        """
+        This function releases the worker threads of the pipeline.
+        Args:
+            wait (bool, optional): Whether to wait for running stages to finish. Defaults to False.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def _submit(self, name: str):
+        """
+        This function submits a stage to the thread pool with its dependency results.
+        """
+        func, depends_on = self.stages[name]
+        args = [self.futures[dependency].result() for dependency in depends_on]
+        inner = self._executor.submit(func, *args)
+        inner.add_done_callback(lambda completed: self._on_complete(name, completed))
+
+    def _on_complete(self, name: str, completed: Future):
+        """
+        This function resolves a stage and schedules the stages that were waiting on it.
+        """
+        future = self.futures[name]
+        if completed.exception() is not None:
+            future.set_exception(completed.exception())
+        else:
+            future.set_result(completed.result())
+
+        for dependent, (_, depends_on) in self.stages.items():
+            if name not in depends_on:
+                continue
+            with self._lock:
+                # Skip stages that were already started or failed by another dependency
+                if self.futures[dependent].done() or self.futures[dependent].running():
+                    continue
+                if not all(self.futures[dep].done() for dep in depends_on):
+                    continue
+                failed = [dep for dep in depends_on if self.futures[dep].exception()]
+                if failed:
+                    self._fail(dependent, self.futures[failed[0]].exception())
+                    continue
+                self.futures[dependent].set_running_or_notify_cancel()
+            self._submit(dependent)
+
+        if self.done():
+            self.shutdown()
+
+    def _fail(self, name: str, exception: BaseException):
+        """
+        This function marks a stage, and every stage depending on it, as failed.
+        """
+        if self.futures[name].done():
+            return
+        self.futures[name].set_exception(exception)
+        for dependent, (_, depends_on) in self.stages.items():
+            if name in depends_on:
+                self._fail(dependent, exception)
@@ -0,0 +1,159 @@
+import logging
+import os
+from typing import Callable, Dict, Optional, Tuple
+from pdf_worker import run_pdf_work
+from response_cache import LRUCache
+
+# Tokens billed for each PDF page sent to Gemini, on top of its text
+PDF_PAGE_TOKENS = 258
+
+# Requests over this many input tokens are summarized with map-reduce
+MAP_REDUCE_TOKEN_THRESHOLD = 200_000
+
+# Sections are generated in parallel while the documents sent with every section fit this budget
+SECTION_PARALLEL_TOKEN_BUDGET = 1_000_000
+
+# Templates with more sections are generated in a single request, as each section resends the documents
+MAX_PARALLEL_SECTIONS = 12
+
+# Chat turns over this many input tokens answer from retrieved pages
+RETRIEVAL_TOKEN_THRESHOLD = 32_000
+
+# Strategies
+SINGLE_SHOT = "single_shot"
+SECTION_PARALLEL = "section_parallel"
+MAP_REDUCE = "map_reduce"
+RETRIEVAL = "retrieval"
+
+STRATEGY_LABELS = {
+    SINGLE_SHOT: "single request",
+    SECTION_PARALLEL: "sections in parallel",
+    MAP_REDUCE: "map-reduce",
+    RETRIEVAL: "retrieval of the relevant pages",
+}
+
+# Token estimates of the files, keyed by content hash, parts mode and counting model
+_file_tokens = LRUCache(max_entries=1024)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    This function estimates the number of tokens in a text, at about four characters per token.
+    Args:
+        text (str): The text to estimate.
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return (len(text) + 3) // 4
+
+
+def estimate_file_tokens_locally(file_locations: Dict) -> int:
+    """
+    This function estimates the input tokens of a file from its page statistics, without calling the model.
+    Args:
+        file_locations (dict): The file information, with its parts plan or opened document.
+    Returns:
+        int: The estimated number of tokens.
+    """
+    # Text pages are sent as text, visual pages as PDF pages
+    parts_plan = file_locations.get("parts_plan")
+    if parts_plan:
+        return sum(
+            estimate_tokens(segment["text"])
+            if segment["type"] == "text"
+            else (segment["last_page"] - segment["first_page"] + 1) * PDF_PAGE_TOKENS
+            for segment in parts_plan
+        )
+
+    # Whole PDF files are billed per page plus their text
+    doc = file_locations.get("doc")
+    if doc is not None:
+        return sum(PDF_PAGE_TOKENS + estimate_tokens(page.get_text()) for page in doc)
+
+    local_path = file_locations.get("local_file_location")
+    if local_path and os.path.exists(local_path):
+        return os.path.getsize(local_path) // 4
+    return 0
+
+
+def estimate_file_tokens(
+    file_locations: Dict,
+    count_tokens: Optional[Callable[[], int]] = None,
+    model_name: str = None,
+) -> Tuple[int, str]:
+    """
+    This function estimates the input tokens of a file, once per file content.
+    The model's token counter is used when given, and the local estimate otherwise or if it fails.
+    Args:
+        file_locations (dict): The file information.
+        count_tokens (Callable, optional): Counts the tokens of the file with the model. Defaults to None.
+        model_name (str, optional): The name of the counting model. Defaults to None.
+    Returns:
+        tuple: The number of tokens and the method used, "count_tokens" or "local".
+    """
+    key = (
+        file_locations.get("content_hash") or file_locations.get("gcs_file_location"),
+        "hybrid" if file_locations.get("parts_plan") else "pdf",
+        model_name if count_tokens else None,
+    )
+    cached_estimate = _file_tokens.get(key)
+    if cached_estimate is not None:
+        return cached_estimate
+
+    estimate = None
+    if count_tokens is not None:
+        try:
+            estimate = (count_tokens(), "count_tokens")
+        except Exception as e:
+            logging.warning(f"Token count failed, using the local estimate: {e}")
+    if estimate is None:
+        estimate = (run_pdf_work(estimate_file_tokens_locally, file_locations), "local")
+
+    _file_tokens.set(key, estimate)
+    return estimate
+
+
+def choose_strategy(
+    task: str,
+    input_tokens: int,
+    section_count: int = 0,
+    allow_sections: bool = True,
+    allow_map_reduce: bool = True,
+    allow_retrieval: bool = True,
+) -> Tuple[str, str]:
+    """
+    This function picks the strategy of a request from its estimated size.
+    Args:
+        task (str): The task, "summary", "memo" or "qa".
+        input_tokens (int): The estimated input tokens of the files.
+        section_count (int, optional): The number of sections of the template. Defaults to 0.
+        allow_sections (bool, optional): Whether sections may be generated in parallel. Defaults to True.
+        allow_map_reduce (bool, optional): Whether the task supports map-reduce. Defaults to True.
+        allow_retrieval (bool, optional): Whether the task supports retrieval. Defaults to True.
+    Returns:
+        tuple: The strategy and the reason for choosing it.
+    """
+    if task == "qa":
+        if allow_retrieval and input_tokens > RETRIEVAL_TOKEN_THRESHOLD:
+            return RETRIEVAL, f"documents over {RETRIEVAL_TOKEN_THRESHOLD:,} tokens"
+        return SINGLE_SHOT, "documents fit a single request"
+
+    if allow_map_reduce and input_tokens > MAP_REDUCE_TOKEN_THRESHOLD:
+        return MAP_REDUCE, f"documents over {MAP_REDUCE_TOKEN_THRESHOLD:,} tokens"
+    if allow_sections and section_count > 1:
+        if section_count > MAX_PARALLEL_SECTIONS:
+            return SINGLE_SHOT, f"{section_count} sections, over the limit of {MAX_PARALLEL_SECTIONS}"
+        if input_tokens * section_count <= SECTION_PARALLEL_TOKEN_BUDGET:
+            return SECTION_PARALLEL, f"{section_count} sections within the token budget"
+        return SINGLE_SHOT, f"{section_count} sections would exceed the token budget"
+    return SINGLE_SHOT, "documents fit a single request"
+
+
+def describe_plan(plan: Dict) -> str:
+    """
+    This function describes a request plan for the UI and the logs.
+    """
+    return (
+        f"Estimated input: ~{plan['input_tokens']:,} tokens ({plan['method']}). "
+        f"Strategy: {STRATEGY_LABELS[plan['strategy']]}, {plan['reason']}."
+    )
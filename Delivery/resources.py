@@ -0,0 +1,63 @@
+import streamlit as st
+import vertexai
+from model_registry import model_registry
+from model_router import model_provider
+
+
+@st.cache_resource
+def init_vertexai(project_id: str, location: str):
+    """
+    This function initializes Vertex AI once per process instead of on every rerun.
+    Args:
+        project_id (str): The Google Cloud project ID.
+        location (str): The Google Cloud region.
+    """
+    vertexai.init(project=project_id, location=location)
+
+
+@st.cache_resource
+def warm_clients(model_names: tuple, markdown_model: str):
+    """
+    This function creates the model clients once at process start, before the first session needs them.
+    Args:
+        model_names (tuple): The names of the models offered in the app.
+        markdown_model (str): The name of the model formatting summaries as markdown.
+    """
+    model_registry.warm(model_names, tasks=("summary", "memo", "editor", "qa"))
+    model_registry.warm((markdown_model,), tasks=("markdown",))
+
+
+def get_client(
+    model_name: str, chatbot_function: str = None, generation_config: dict = None, task: str = None
+):
+    """
+    This function returns a long-lived model client from the process-wide registry.
+    Args:
+        model_name (str): The name of the model to use.
+        chatbot_function (str, optional): The chatbot function to use. Specifies system instructions. Defaults to None.
+        generation_config (dict, optional): The generation defaults of the client. Defaults to None.
+        task (str, optional): The task the requests are routed for. Defaults to the chatbot function.
+    Returns:
+        A RegisteredModel object.
+    """
+    return model_registry.get(
+        model_name=model_name,
+        chatbot_function=chatbot_function,
+        generation_config=generation_config,
+        task=task,
+    )
+
+
+def get_markdown_client(markdown_model: str, model_name: str = None):
+    """
+    This function returns the client formatting summaries as markdown, from the provider of the selected model.
+    Secure GPT sessions format with Secure GPT, so their summaries are never sent to Vertex AI.
+    Args:
+        markdown_model (str): The model formatting summaries as markdown.
+        model_name (str, optional): The model selected in the session. Defaults to None.
+    Returns:
+        A RegisteredModel object.
+    """
+    if model_name and model_provider(model_name) != model_provider(markdown_model):
+        markdown_model = model_name
+    return get_client(model_name=markdown_model, task="markdown")
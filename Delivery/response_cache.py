@@ -0,0 +1,316 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from dotenv import load_dotenv
+
+
+class LRUCache:
+    """
+    A thread-safe, in-memory LRU cache holding at most a fixed number of entries.
+    Used for the per-file caches of the long-lived server process, which are shared by all sessions.
+    """
+
+    def __init__(self, max_entries: int):
+        """
+        Args:
+            max_entries (int): The maximum number of entries. The least recently used are evicted first.
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        This function returns a cached value and marks it as recently used.
+        """
+        with self._lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        """
+        This function caches a value, evicting the least recently used entries over the limit.
+        """
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self.entries)
+
+
+# Content hashes of local files, keyed by (path, size, modification time)
+_file_hashes = LRUCache(max_entries=1024)
+
+
+def file_content_hash(path: str) -> str:
+    """
+    This function computes the SHA-256 hash of a local file.
+    Hashes are remembered until the file changes on disk.
+    Args:
+        path (str): The path to the file.
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    content_hash = _file_hashes.get(key)
+    if content_hash is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        content_hash = digest.hexdigest()
+        _file_hashes.set(key, content_hash)
+    return content_hash
+
+
+def files_content_hashes(files: Dict[str, Dict[str, str]]) -> list:
+    """
+    This function returns the content hashes of the files sent to the model.
+    Args:
+        files (dict): A dictionary containing the file locations.
+    Returns:
+        list: The sorted content hashes of the files.
+    """
+    hashes = []
+    for file_locations in files.values():
+        if "gcs_file_location" not in file_locations:
+            continue
+        if "content_hash" in file_locations:
+            hashes.append(file_locations["content_hash"])
+        elif "local_file_location" in file_locations:
+            hashes.append(file_content_hash(file_locations["local_file_location"]))
+        else:
+            hashes.append(file_locations["gcs_file_location"])
+    return sorted(hashes)
+
+
+def make_cache_key(
+    model_name: str,
+    system_instruction: Optional[str],
+    contents: list,
+    generation_config: dict,
+    file_hashes: list = (),
+) -> str:
+    """
+    This function builds a content-addressed key for a model request.
+    Args:
+        model_name (str): The name of the model.
+        system_instruction (str): The system instructions of the model.
+        contents (list): The prompt strings and parts that are not covered by the file hashes.
+        generation_config (dict): The generation config, including the temperature.
+        file_hashes (list, optional): The content hashes of the input files.
+    Returns:
+        str: The hex digest identifying the request.
+    """
+    serialized_contents = []
+    for content in contents:
+        if isinstance(content, str):
+            serialized_contents.append(content)
+        elif hasattr(content, "to_dict"):
+            serialized_contents.append(json.dumps(content.to_dict(), sort_keys=True))
+        else:
+            serialized_contents.append(repr(content))
+
+    payload = json.dumps(
+        {
+            "model_name": model_name,
+            "system_instruction": system_instruction or "",
+            "contents": serialized_contents,
+            "generation_config": generation_config,
+            "file_hashes": list(file_hashes),
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    The interface of a model response cache. Subclasses store the responses.
+    The base class keeps the hit and miss counters and never stores anything.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        This function looks up a cached response and updates the counters.
+        Args:
+            key (str): The cache key.
+        Returns:
+            str: The cached response text, or None on a miss.
+        """
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        """
+        This function stores a response.
+        Args:
+            key (str): The cache key.
+            value (str): The response text.
+        """
+        return
+
+    def stats(self) -> dict:
+        """
+        This function returns the hit and miss counters of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _get(self, key: str) -> Optional[str]:
+        return None
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    A response cache stored in a SQLite file, shared by every session of the app.
+    Entries expire after a TTL, and the least recently used entries are evicted
+    once the cache grows beyond its size limit.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_bytes: int = 256 * 1024 * 1024,
+    ):
+        """
+        Args:
+            path (str): The path to the SQLite file.
+            ttl_seconds (float, optional): How long entries are kept. Defaults to one week.
+            max_bytes (int, optional): The maximum size of the stored responses. Defaults to 256 MB.
+        """
+        super().__init__()
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            # Drop the entry if it has expired
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._connection.commit()
+            return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def clear(self):
+        """
+        This function removes every entry from the cache.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {**super().stats(), "entries": entries, "bytes": size}
+
+    def _evict(self, now: float):
+        """
+        This function removes expired entries, then the least recently used entries over the size limit.
+        """
+        self._connection.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        (total_size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total_size <= self.max_bytes:
+            return
+
+        rows = self._connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+
+
+def create_response_cache() -> ResponseCache:
+    """
+    This function creates the response cache configured by the environment.
+    Set RESPONSE_CACHE_PATH to choose the SQLite file, or RESPONSE_CACHE_ENABLED=False to disable caching.
+    Returns:
+        A ResponseCache object.
+    """
+    load_dotenv()
+    if os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() == "false":
+        return ResponseCache()
+
+    path = os.getenv("RESPONSE_CACHE_PATH") or os.path.join(
+        tempfile.gettempdir(), "v_accelerate_responses.sqlite"
+    )
+    return SQLiteResponseCache(
+        path,
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS") or 7 * 24 * 3600),
+        max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES") or 256 * 1024 * 1024),
+    )
+
+
+# Shared cache for all sessions of the app
+response_cache = create_response_cache()
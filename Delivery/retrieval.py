@@ -0,0 +1,122 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+# Common words that carry no meaning for retrieval
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for", "from",
+    "has", "have", "how", "in", "is", "it", "its", "of", "on", "or", "that", "the",
+    "their", "this", "to", "was", "were", "what", "when", "where", "which", "who",
+    "why", "will", "with", "you", "your",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    This function splits a text into lowercase search terms.
+    Args:
+        text (str): The text to split.
+    Returns:
+        list: The search terms, without stopwords.
+    """
+    return [
+        token
+        for token in re.findall(r"[a-z0-9]+(?:[.,][0-9]+)*", text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+def extract_page_texts(doc) -> List[str]:
+    """
+    This function extracts the text of each page of a document.
+    Args:
+        doc (pymupdf.Document): The opened document.
+    Returns:
+        list: The text of each page, in page order.
+    """
+    return [page.get_text() for page in doc]
+
+
+class PageIndex:
+    """
+    An in-process BM25 index over the pages of the uploaded documents.
+    Used by the Q&A chatbot to send only the most relevant pages to the model.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            k1 (float, optional): The BM25 term frequency saturation. Defaults to 1.5.
+            b (float, optional): The BM25 length normalization. Defaults to 0.75.
+        """
+        self.k1 = k1
+        self.b = b
+        self.pages: List[Dict] = []
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.total_length = 0
+
+    def add_document(self, file_name: str, page_texts: List[str]):
+        """
+        This function adds the pages of a document to the index.
+        Args:
+            file_name (str): The name of the document.
+            page_texts (list): The text of each page, in page order.
+        """
+        for page_number, text in enumerate(page_texts, start=1):
+            page_id = len(self.pages)
+            term_counts = Counter(tokenize(text))
+            length = sum(term_counts.values())
+            self.pages.append(
+                {
+                    "file_name": file_name,
+                    "page_number": page_number,
+                    "text": text,
+                    "length": length,
+                }
+            )
+            self.total_length += length
+            for term, count in term_counts.items():
+                self.postings[term][page_id] = count
+
+    def search(self, query: str, k: int = 8) -> List[Dict]:
+        """
+        This function finds the pages most relevant to a query.
+        Args:
+            query (str): The search query.
+            k (int, optional): The maximum number of pages to return. Defaults to 8.
+        Returns:
+            list: The matching pages with their file name, page number, text and score, best first.
+        """
+        if not self.pages:
+            return []
+
+        average_length = self.total_length / len(self.pages) or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.pages) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for page_id, count in postings.items():
+                length_norm = 1 - self.b + self.b * self.pages[page_id]["length"] / average_length
+                scores[page_id] += idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [{**self.pages[page_id], "score": score} for page_id, score in best]
+
+
+def format_retrieved_pages(pages: List[Dict]) -> List[str]:
+    """
+    This function formats retrieved pages as labeled excerpts for the LLM.
+    Args:
+        pages (list): The pages returned by PageIndex.search.
+    Returns:
+        list[str]: One excerpt per page, labeled with its file name and page number.
+    """
+    # Present the pages in document order so the context reads naturally
+    ordered = sorted(pages, key=lambda page: (page["file_name"], page["page_number"]))
+    return [
+        f"[{page['file_name']}, page {page['page_number']}]\n{page['text'].strip()}"
+        for page in ordered
+    ]
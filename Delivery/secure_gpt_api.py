@@ -1,34 +1,342 @@
-import requests 
-import json 
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+import pymupdf
+import requests
+from requests.adapters import HTTPAdapter
+from get_access_token import get_access_token
+from document_parts import parse_segment_label
+from pdf_worker import run_pdf_work
+from response_cache import LRUCache
+
+TOKEN_URL = "https://api.veolia.com/security/v2/oauth/token"
+API_URL = "https://api.veolia.com/llm/veoliasecuregpt/v1/answer"
+
+# Name of the Secure GPT option in the model selection
+SECURE_GPT_MODEL = "Secure GPT"
+
+# Connection, retry and concurrency defaults of the client
+DEFAULT_TIMEOUT = (10, 300)  # Connect and read timeouts in seconds
+DEFAULT_DEADLINE = 600  # Total seconds for a request, including retries
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_MAX_CONCURRENCY = 8
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-# Function to chat with the Veolia Secure GPT API
-def chat_with_api(prompt: str, access_token: str, client_email: str,
-                  temperature: float = 0.1, top_p: int = 1,
-                  model: str = "gemini-pro-vision-1.5"):
-                
-    api_url = 'https://api.veolia.com/llm/veoliasecuregpt/v1/answer'
 
-    headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-    }
+class SecureGPTError(Exception):
+    """
+    Raised when the Secure GPT API returns an error or cannot be reached before the deadline.
+    """
 
-    data = {
-    "useremail": f"{client_email}",
+    def __init__(self, message: str, status_code: int = None):
+        self.status_code = status_code
+        super().__init__(message)
 
-    "history": [
-        {
-            "role": "user",
-            "content": prompt
+
+class SecureGPTClient:
+    """
+    A client for the Veolia Secure GPT API.
+    Requests share a keep-alive connection pool, are limited to max_concurrency at a time,
+    and are retried with exponential backoff on 429 and 5xx responses until the deadline.
+    """
+
+    def __init__(
+        self,
+        client_email: str,
+        token_provider: Callable[[], str] = None,
+        api_url: str = API_URL,
+        timeout=DEFAULT_TIMEOUT,
+        deadline: float = DEFAULT_DEADLINE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    ):
+        """
+        Args:
+            client_email (str): The email of the user of the API.
+            token_provider (Callable, optional): Returns a valid access token. Defaults to the shared token manager.
+            api_url (str, optional): The Secure GPT answer endpoint.
+            timeout (tuple, optional): The connect and read timeouts of each attempt, in seconds.
+            deadline (float, optional): The total seconds allowed for a request, including retries.
+            max_retries (int, optional): The maximum number of retries of a request.
+            max_concurrency (int, optional): The maximum number of requests in flight.
+        """
+        self.client_email = client_email
+        self.token_provider = token_provider or (lambda: get_access_token(TOKEN_URL, api_url))
+        self.api_url = api_url
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        # Keep connections alive across requests
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def chat(self, history: List[Dict], temperature: float = 0.1, top_p: float = 1,
+             model: str = None, deadline: float = None):
+        """
+        This function sends a conversation to the API and returns the answer.
+        Args:
+            history (list): The messages, each with a "role" and "content".
+            temperature (float, optional): The temperature for the model generation. Defaults to 0.1.
+            top_p (float, optional): The top_p for the model generation. Defaults to 1.
+            model (str, optional): The backend model. Defaults to the API default.
+            deadline (float, optional): Seconds allowed for this request. Defaults to the client deadline.
+        Returns:
+            The answer of the API.
+        """
+        data = {
+            "useremail": f"{self.client_email}",
+            "history": history,
+            "temperature": temperature,
+            "top_p": top_p,
         }
-    ],
-    "temperature": temperature,
-    "top_p": top_p,
-    "model": model,
-}
-    response = requests.post(api_url, headers=headers, data=json.dumps(data))
-
-    if response.status_code == 200:
-        return (response.json())
-    else:
-        raise Exception(f"API call failed with status code {response.status_code}")
+        if model:
+            data["model"] = model
+
+        give_up_at = time.monotonic() + (deadline or self.deadline)
+        with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    raise SecureGPTError("Secure GPT request exceeded its deadline")
+
+                headers = {
+                    "Authorization": f"Bearer {self.token_provider()}",
+                    "Content-Type": "application/json",
+                }
+                response = None
+                try:
+                    response = self._session.post(
+                        self.api_url,
+                        headers=headers,
+                        data=json.dumps(data),
+                        timeout=(self.timeout[0], min(self.timeout[1], remaining)),
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = SecureGPTError(f"Secure GPT request failed: {e}")
+                else:
+                    if response.status_code == 200:
+                        return response.json()
+                    error = SecureGPTError(
+                        f"API call failed with status code {response.status_code}: {response.text[:500]}",
+                        status_code=response.status_code,
+                    )
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        raise error
+
+                if attempt == self.max_retries:
+                    raise error
+
+                # Back off exponentially with jitter, honoring Retry-After when given
+                delay = min(2**attempt + random.random(), 30)
+                retry_after = response.headers.get("Retry-After") if response is not None else None
+                if retry_after and retry_after.isdigit():
+                    delay = float(retry_after)
+                logging.warning(f"{error}. Retrying in {delay:.1f}s")
+                time.sleep(min(delay, max(give_up_at - time.monotonic(), 0)))
+
+        raise SecureGPTError("Secure GPT request failed")
+
+    async def achat(self, history: List[Dict], **kwargs):
+        """
+        This function is the asyncio variant of chat. Requests run on worker threads,
+        so many can be awaited together without blocking the event loop.
+        Args:
+            history (list): The messages, each with a "role" and "content".
+            **kwargs: The generation arguments of chat.
+        Returns:
+            The answer of the API.
+        """
+        return await asyncio.to_thread(self.chat, history, **kwargs)
+
+    async def achat_many(self, histories: List[List[Dict]], **kwargs):
+        """
+        This function sends several conversations concurrently, within the concurrency limit.
+        Args:
+            histories (list): The conversations to send.
+            **kwargs: The generation arguments of chat.
+        Returns:
+            list: The answers, in the order of the conversations.
+        """
+        return await asyncio.gather(*(self.achat(history, **kwargs) for history in histories))
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_secure_gpt_client():
+    """
+    This function returns the Secure GPT client shared by all sessions.
+    The user email is read from the SECURE_GPT_USER_EMAIL environment variable.
+    Returns:
+        SecureGPTClient: The shared client.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = SecureGPTClient(client_email=os.getenv("SECURE_GPT_USER_EMAIL"))
+    return _default_client
+
+
+class SecureGPTResponse:
+    """
+    A response of the Secure GPT API, with the text attribute of a Gemini response.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class SecureGPTModel:
+    """
+    An adapter giving the Secure GPT API the generate_content interface of a Gemini
+    GenerativeModel, so it can back the summary, memo and chat functions.
+    Files are sent as their extracted text, labeled with page numbers.
+    """
+
+    def __init__(self, system_instruction: str = None, client: SecureGPTClient = None,
+                 model: str = None, generation_config: dict = None):
+        """
+        Args:
+            system_instruction (str, optional): The system instructions of the model.
+            client (SecureGPTClient, optional): The client to use. Defaults to the shared client.
+            model (str, optional): The backend model. Defaults to the API default.
+            generation_config (dict, optional): The generation defaults, overridden per request.
+        """
+        self.client = client or get_secure_gpt_client()
+        self.generation_config = generation_config or {}
+        self.model = model
+        self._model_name = f"secure-gpt/{model or 'default'}"
+        self._system_instruction = system_instruction
+
+    def generate_content(self, contents, generation_config: dict = None, stream: bool = False):
+        """
+        This function generates a response for the contents.
+        Args:
+            contents (list): The prompt strings and Part objects.
+            generation_config (dict, optional): The generation config.
+            stream (bool, optional): Whether to return the response as a stream of one chunk.
+        Returns:
+            A SecureGPTResponse, or a list with one SecureGPTResponse if streaming.
+        """
+        generation_config = {**self.generation_config, **(generation_config or {})}
+
+        texts = [self._system_instruction] if self._system_instruction else []
+
+        # Files and PDF excerpts follow a label with their file name and original first page
+        excerpt_label = None
+        for content in contents:
+            if excerpt_label is not None:
+                texts.append(content_to_text(content, *excerpt_label))
+            else:
+                texts.append(content_to_text(content))
+            excerpt_label = parse_segment_label(content) if isinstance(content, str) else None
+
+        # Ask for JSON in the prompt when a response schema is requested
+        if "response_schema" in generation_config:
+            texts.append(
+                "Respond only with JSON following this JSON schema:\n"
+                + json.dumps(generation_config["response_schema"])
+            )
+
+        answer = self.client.chat(
+            history=[{"role": "user", "content": "\n\n".join(texts)}],
+            temperature=generation_config.get("temperature", 0.1),
+            top_p=generation_config.get("top_p", 1),
+            model=self.model,
+        )
+        response = SecureGPTResponse(answer if isinstance(answer, str) else json.dumps(answer))
+        return [response] if stream else response
+
+
+# Extracted text of the files sent to Secure GPT, keyed by GCS URI and label
+_file_texts = LRUCache(max_entries=64)
+
+
+def document_to_text(doc, label: str, first_page: int = 1) -> str:
+    """
+    This function extracts the text of a document with a label for each page.
+    Args:
+        doc (pymupdf.Document): The opened document.
+        label (str): The name of the document.
+        first_page (int, optional): The page number of the first page. Defaults to 1.
+    Returns:
+        str: The labeled text of the pages.
+    """
+    return "\n\n".join(
+        f"[{label}, page {page_number}]\n{page.get_text().strip()}"
+        for page_number, page in enumerate(doc, start=first_page)
+    )
+
+
+def pdf_to_text(data: bytes, label: str, first_page: int = 1) -> str:
+    """
+    This function opens a PDF from memory and extracts its labeled text.
+    """
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        return document_to_text(doc, label, first_page)
+
+
+def content_to_text(content, label: str = None, first_page: int = 1) -> str:
+    """
+    This function converts a prompt string or Part object to text for Secure GPT.
+    Args:
+        content (str or Part): The content.
+        label (str, optional): The file name of the file or PDF excerpt. Defaults to the blob name or "excerpt".
+        first_page (int, optional): The original page number of the first page of the excerpt. Defaults to 1.
+    Returns:
+        str: The text of the content.
+    """
+    if isinstance(content, str):
+        return content
+
+    part = content.to_dict()
+
+    # Files in GCS, downloaded and extracted once per URI
+    if "file_data" in part:
+        uri = part["file_data"]["file_uri"]
+        text = _file_texts.get((uri, label))
+        if text is not None:
+            return text
+
+        from utils import get_storage_client
+
+        bucket_name, blob_name = uri[len("gs://"):].split("/", 1)
+        data = get_storage_client().bucket(bucket_name).blob(blob_name).download_as_bytes()
+        mime_type = part["file_data"].get("mime_type", "")
+        if mime_type.startswith("text/"):
+            text = data.decode("utf-8", errors="replace")
+        else:
+            # Blobs are named by content hash, so prefer the file name from the label
+            text = run_pdf_work(pdf_to_text, data, label or os.path.basename(blob_name))
+
+        _file_texts.set((uri, label), text)
+        return text
+
+    # Inline PDFs, e.g. the page ranges of map-reduce
+    if "inline_data" in part:
+        return run_pdf_work(pdf_to_text, content.inline_data.data, label or "excerpt", first_page)
+
+    return getattr(content, "text", "") or ""
+
+
+# Function to chat with the Veolia Secure GPT API
+def chat_with_api(prompt: str, access_token: str, client_email: str,
+                  temperature: float = 0.1, top_p: int = 1,
+                  model: str = "gemini-pro-vision-1.5"):
+    client = SecureGPTClient(client_email=client_email, token_provider=lambda: access_token)
+    return client.chat(
+        history=[{"role": "user", "content": prompt}],
+        temperature=temperature,
+        top_p=top_p,
+        model=model,
+    )
@@ -1,33 +1,320 @@
 from google.cloud import storage
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
 import os 
+import threading
+import requests
 import streamlit as st
 import pymupdf 
+import json
+from retrieval import PageIndex, extract_page_texts
+from document_parts import build_parts_plan, use_hybrid_parts
+from pdf_optimizer import slim_pdf
+from pdf_worker import run_pdf_work
 
-def upload_blob(bucket_name, destination_blob_name, file):
+# Number of files uploaded in parallel, and the size above which uploads are chunked
+INGEST_CONCURRENCY = 8
+RESUMABLE_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Must be a multiple of 256 KB
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+# Metadata of the files already stored in GCS, keyed by content hash
+_blob_index = {}
+_blob_index_lock = threading.Lock()
+
+
+def get_storage_client():
+    """
+    This function returns a storage client shared by all uploads of the process.
+    Its connection pool is sized for parallel uploads.
+    Returns:
+        storage.Client: The shared client.
+    """
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            client = storage.Client()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=INGEST_CONCURRENCY, pool_maxsize=INGEST_CONCURRENCY
+            )
+            client._http.mount("https://", adapter)
+            _storage_client = client
+    return _storage_client
+
+
+def upload_blob(bucket_name, destination_blob_name, file, content_type=None):
     """ 
     This function uploads a file to a specified bucket in Google Cloud Storage.
+    Files larger than RESUMABLE_UPLOAD_THRESHOLD are uploaded in chunks with a resumable upload.
     Args:
         bucket_name (str): The name of the bucket to upload to. 
         destination_blob_name (str): The name of the file in the bucket.
-        file: The file to upload.
+        file: The file to upload, as a file object or bytes.
+        content_type (str, optional): The mime type of the file.
     Returns:
         str: The full GCS URL of the uploaded file.
     """
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_file(file)
+    # Wrap bytes without copying them
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        size = len(file)
+        file = io.BytesIO(file)
+    else:
+        size = None
+
+    chunk_size = UPLOAD_CHUNK_SIZE if size is None or size > RESUMABLE_UPLOAD_THRESHOLD else None
+    blob = bucket.blob(destination_blob_name, chunk_size=chunk_size)
+
+    blob.upload_from_file(file, size=size, content_type=content_type)
 
     return f"gs://{bucket_name}/{destination_blob_name}"
 
+def upload_content_addressed(bucket_name, data, content_type, page_count=None):
+    """
+    This function stores a file in GCS under its content hash, skipping the upload if it is already stored.
+    Metadata is kept next to each blob as blobs/sha256/<hash>.json and cached in memory,
+    so repeat uploads of the same file by any session reuse the stored copy.
+    Args:
+        bucket_name (str): The name of the bucket to upload to.
+        data (bytes): The file contents.
+        content_type (str): The mime type of the file.
+        page_count (int, optional): The number of pages of the file.
+    Returns:
+        dict: The metadata of the stored file, with its content hash, GCS URI, mime type and page count.
+    """
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    with _blob_index_lock:
+        if content_hash in _blob_index:
+            return _blob_index[content_hash]
+
+    bucket = get_storage_client().bucket(bucket_name)
+    blob_name = f"blobs/sha256/{content_hash}"
+    metadata_blob = bucket.blob(f"{blob_name}.json")
+
+    # Reuse the stored file if another session or process already uploaded it
+    if metadata_blob.exists():
+        metadata = json.loads(metadata_blob.download_as_bytes())
+    else:
+        gcs_uri = upload_blob(bucket_name, blob_name, data, content_type=content_type)
+        metadata = {
+            "content_hash": content_hash,
+            "gcs_file_location": gcs_uri,
+            "mime_type": content_type,
+            "page_count": page_count,
+            "size": len(data),
+        }
+        # Write the metadata last, so it only exists once the file is fully stored
+        metadata_blob.upload_from_string(
+            json.dumps(metadata), content_type="application/json"
+        )
+
+    with _blob_index_lock:
+        _blob_index[content_hash] = metadata
+    return metadata
+
+
 # Render markdown for streamlit
 def render_markdown(text):
     text = text.replace("\\", "\\\\").replace("$", "\$").replace("<br>", " ")
     return text
 
 
+def complete_partial_json(text):
+    """
+    This function closes the open strings, objects and arrays of a partially streamed JSON response.
+    Args:
+        text (str): The JSON text received so far.
+    Returns:
+        str: The JSON text with the missing closing characters appended.
+    """
+    closers = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            closers.append("}")
+        elif char == "[":
+            closers.append("]")
+        elif char in "}]" and closers:
+            closers.pop()
+
+    completed = text + ('"' if in_string else "")
+    return completed.rstrip().rstrip(",") + "".join(reversed(closers))
+
+
+def extract_json_text(text):
+    """
+    This function strips a code fence and any prose around a JSON object in a model response.
+    Models asked for JSON in the prompt, such as Secure GPT, often wrap it in a ```json fence.
+    Args:
+        text (str): The response text.
+    Returns:
+        str: The text from the first "{" to the last "}", or from the first "{" if the object is not closed yet.
+    """
+    start = text.find("{")
+    if start == -1:
+        return text
+    end = text.rfind("}")
+    if end < start:
+        # Still being streamed, drop a closing fence that may have started
+        return text[start:].rstrip("`").rstrip()
+    return text[start : end + 1]
+
+
+def render_summary_markdown(summary, partial=False):
+    """
+    This function renders a structured summary as markdown tables, one per section.
+    Args:
+        summary (str): The summary as JSON with sections, fields, values and page references.
+        partial (bool, optional): Whether the summary is still being streamed. Defaults to False.
+    Returns:
+        str: The summary as markdown, or None if the summary is not valid JSON.
+    """
+    summary = extract_json_text(summary)
+    try:
+        data = json.loads(complete_partial_json(summary) if partial else summary)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    # Escape characters that would break the table layout
+    def cell(value):
+        return str(value).replace("|", "&#124;").replace("\n", " ").strip()
+
+    lines = []
+    for section in data.get("sections", []):
+        if not isinstance(section, dict):
+            continue
+        lines += [f"### {section.get('title', '')}", ""]
+        lines += ["| Field | Details | Page(s) |", "| --- | --- | --- |"]
+        for field in section.get("fields", []):
+            if not isinstance(field, dict):
+                continue
+            lines.append(
+                f"| {cell(field.get('field', ''))} | {cell(field.get('value', ''))} "
+                f"| {cell(field.get('pages', ''))} |"
+            )
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def prepare_upload(file, file_type, temp_dir, slim_options=None):
+    """
+    This function saves a local copy of a file, opens it for rendering and extracts its pages.
+    The file is read once and the same buffer feeds the local copy, pymupdf and the upload.
+    pymupdf is not thread-safe and holds the GIL, so files are prepared one at a time on the pymupdf thread.
+    Args:
+        file: The file to upload.
+        file_type (str): The type of file being uploaded. Either "document", "template", or "memo".
+        temp_dir (str): The directory for the local copy.
+        slim_options (dict, optional): The arguments of slim_pdf, to optimize PDFs before upload. Defaults to None.
+    Returns:
+        tuple: The file contents to upload and the file information, without its GCS location.
+    """
+
+    # Read the file once
+    data = file.getvalue()
+
+    # Optimize PDFs, so the smaller file is uploaded, rendered and sent to the model
+    slim_report = None
+    if slim_options is not None and file.type == "application/pdf":
+        data, slim_report = slim_pdf(data, **slim_options)
+
+    # Save file to local path for rendering
+    path = os.path.join(temp_dir, file.name)
+    with open(path, "wb") as f:
+        f.write(data)
+
+    # Open the document from memory, named after the local copy
+    doc = pymupdf.open(path, stream=data)
+
+    return data, {
+        "file_type": file_type, # "document", "template", or "memo"
+        "local_file_location": path, # Local path to the file
+        "mime_type": file.type, # Mime type of the file
+        "doc": doc,  # Opened document for rendering
+        "page_count": doc.page_count, # Number of pages, read here so uploads do not touch the document
+        # Page text for the Q&A chatbot index
+        "page_texts": extract_page_texts(doc) if file_type == "document" else None,
+        # Text and visual page excerpts sent to the LLM instead of the whole file
+        "parts_plan": build_parts_plan(doc, file.name) if use_hybrid_parts() else None,
+        "slim_report": slim_report, # Bytes saved by the PDF optimization
+    }
+
+
+def upload_prepared(bucket_name, data, file_info):
+    """
+    This function uploads a prepared file to GCS, unless the same content is already stored.
+    It does no pymupdf work, so several files can be uploaded in parallel.
+    Args:
+        bucket_name (str): The name of the bucket to upload to.
+        data (bytes): The file contents.
+        file_info (dict): The file information returned by prepare_upload.
+    Returns:
+        dict: The file information with its GCS location and content hash.
+    """
+    stored_file = upload_content_addressed(
+        bucket_name, data, content_type=file_info["mime_type"], page_count=file_info["page_count"]
+    )
+    return {
+        **file_info,
+        "gcs_file_location": stored_file["gcs_file_location"], # GCS path to the file
+        "content_hash": stored_file["content_hash"], # SHA-256 of the file contents
+    }
+
+
+def process_upload(bucket_name, file, file_type, temp_dir, slim_options=None):
+    """
+    This function uploads a file to GCS, saves a local copy and opens it for rendering.
+    Args:
+        bucket_name (str): The name of the bucket to upload to.
+        file: The file to upload.
+        file_type (str): The type of file being uploaded. Either "document", "template", or "memo".
+        temp_dir (str): The directory for the local copy.
+        slim_options (dict, optional): The arguments of slim_pdf, to optimize PDFs before upload. Defaults to None.
+    Returns:
+        dict: The file information saved to the session state.
+    """
+    data, file_info = run_pdf_work(prepare_upload, file, file_type, temp_dir, slim_options)
+    return upload_prepared(bucket_name, data, file_info)
+
+
+def save_upload(file_name, file_info):
+    """
+    This function saves a processed file to the session state and indexes its pages.
+    Args:
+        file_name (str): The name of the file.
+        file_info (dict): The file information returned by process_upload.
+    """
+    page_texts = file_info.pop("page_texts", None)
+
+    # Index the pages of the documents for the Q&A chatbot
+    if page_texts is not None:
+        if "page_index" not in st.session_state:
+            st.session_state.page_index = PageIndex()
+        st.session_state.page_index.add_document(file_name, page_texts)
+
+    # Save locations of the files to the session state
+    st.session_state.files.update({file_name: file_info})
+
+
 def upload_gcs_and_save(bucket_name, file, file_type):
     """ 
     This function uploads a file to GCS and saves the file information to the session state.
@@ -38,31 +325,48 @@ def upload_gcs_and_save(bucket_name, file, file_type):
     Returns:
         str: The local path to the uploaded file.
     """
+    file_info = process_upload(bucket_name, file, file_type, st.session_state.temp_dir)
+    save_upload(file.name, file_info)
 
-    # Create a timestamp for the files
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return file_info["local_file_location"]
 
-    # Upload the files to GCS 
-    gcs_location = upload_blob(
-        bucket_name, f"files/{timestamp}/{file.name}", file
-    )
 
-    # Save file to local path for rendering
-    path = os.path.join(st.session_state.temp_dir, file.name)
-    with open(path, "wb") as f:
-        f.write(file.getvalue())
+def ingest_files(bucket_name, files_with_types, slim_options=None, exclude_pages=None):
+    """
+    This function uploads and saves several files.
+    The files are opened and processed one at a time, and only their uploads run in parallel.
+    Args:
+        bucket_name (str): The name of the bucket to upload to.
+        files_with_types (list): (file, file_type) pairs to process.
+        slim_options (dict, optional): The arguments of slim_pdf, to optimize PDFs before upload. Defaults to None.
+        exclude_pages (str, optional): Page ranges to drop from the documents, e.g. "1-3, 140-150". Defaults to None.
+    Returns:
+        list: The local paths to the uploaded files.
+    """
+    temp_dir = st.session_state.temp_dir
 
-    # Save locations of the files to the session state
-    st.session_state.files.update(
-        {
-            file.name: {
-                "file_type": file_type, # "document", "template", or "memo"
-                "local_file_location": path, # Local path to the file
-                "gcs_file_location": gcs_location, # GCS path to the file
-                "mime_type": file.type, # Mime type of the file
-                "doc": pymupdf.open(path)  # Opened document for rendering
-            }
-        }
-    )
+    def options_for(file_type):
+        # Only the information documents have pages to exclude
+        if slim_options is None:
+            return None
+        if file_type == "document" and exclude_pages:
+            return {**slim_options, "exclude_pages": exclude_pages}
+        return slim_options
+
+    with ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY) as executor:
+        futures = []
+        for file, file_type in files_with_types:
+            # Start each upload as soon as its file is prepared, while the next file is processed
+            data, file_info = run_pdf_work(
+                prepare_upload, file, file_type, temp_dir, options_for(file_type)
+            )
+            futures.append(
+                (file.name, executor.submit(upload_prepared, bucket_name, data, file_info))
+            )
+        # Save in upload order, on the script thread
+        file_infos = [(file_name, future.result()) for file_name, future in futures]
+
+    for file_name, file_info in file_infos:
+        save_upload(file_name, file_info)
 
-    return path
+    return [file_info["local_file_location"] for _, file_info in file_infos]
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app modules are imported from Delivery, as when the app runs from there
+DELIVERY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Delivery")
+sys.path.insert(0, DELIVERY_DIR)
@@ -0,0 +1,179 @@
+import os
+import pytest
+from conftest import DELIVERY_DIR
+from memo_formatter import fetch_headers, format_document
+
+# Text of the sample memo following each subheading
+FILLER = "Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+
+
+class FakeRequest:
+    """
+    A Docs API request that runs on execute and is counted by the fake service.
+    """
+
+    def __init__(self, service, name: str, run):
+        self.service = service
+        self.name = name
+        self.run = run
+
+    def execute(self):
+        self.service.calls.append(self.name)
+        return self.run()
+
+
+class FakeDocsService:
+    """
+    An in-memory stand-in for the Docs API service.
+    The document is a single plain-text body starting at index 1, after the section break,
+    and batch updates are applied to it in order, as the Docs API does.
+    """
+
+    def __init__(self, text: str):
+        """
+        Args:
+            text (str): The text of the document body.
+        """
+        self.text = text
+        self.calls = []
+        self.paragraph_styles = []
+        self.text_styles = []
+
+    def documents(self):
+        return self
+
+    def get(self, documentId: str):
+        body = {
+            "content": [
+                {"endIndex": 1, "sectionBreak": {}},
+                {"paragraph": {"elements": [{"textRun": {"content": self.text}}]}},
+            ]
+        }
+        return FakeRequest(self, "get", lambda: {"documentId": documentId, "body": body})
+
+    def batchUpdate(self, documentId: str, body: dict):
+        return FakeRequest(self, "batchUpdate", lambda: self.apply(body["requests"]))
+
+    def insert(self, index: int, text: str):
+        """
+        This function inserts text at a document index.
+        """
+        self.text = self.text[: index - 1] + text + self.text[index - 1:]
+
+    def apply(self, requests: list):
+        """
+        This function applies the requests of a batch update, recording the text of each styled range.
+        Page breaks and inline images take up one index, like in a Google Doc.
+        """
+        for request in requests:
+            if "insertText" in request:
+                self.insert(request["insertText"]["location"]["index"], request["insertText"]["text"])
+            elif "insertPageBreak" in request:
+                self.insert(request["insertPageBreak"]["location"]["index"], "\f")
+            elif "insertInlineImage" in request:
+                self.insert(request["insertInlineImage"]["location"]["index"], "\ufffc")
+            elif "updateParagraphStyle" in request:
+                style = request["updateParagraphStyle"]
+                start, end = style["range"]["startIndex"], style["range"]["endIndex"]
+                self.paragraph_styles.append(
+                    (
+                        style["paragraphStyle"]["namedStyleType"],
+                        self.text[start - 1 : end - 1],
+                        self.text[end - 1 : end],
+                    )
+                )
+            elif "updateTextStyle" in request:
+                style = request["updateTextStyle"]
+                self.text_styles.append(
+                    (style["range"]["startIndex"], style["range"]["endIndex"], len(self.text) + 1)
+                )
+        return {"documentId": "memo", "replies": [{} for _ in requests]}
+
+
+def build_sample_memo(heading_titles: list, subheading_titles: list) -> str:
+    """
+    This function builds a memo with every heading, and the subheadings spread across them,
+    each followed by its text on the same line as in the model output.
+    """
+    per_heading = -(-len(subheading_titles) // len(heading_titles))
+    lines = []
+    for heading_number, heading in enumerate(heading_titles):
+        lines.append(heading)
+        for subheading in subheading_titles[heading_number * per_heading : (heading_number + 1) * per_heading]:
+            lines.append(f"{subheading} {FILLER}")
+        lines.append(FILLER)
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def titles():
+    """
+    The heading and subheading titles of the memo.
+    """
+    elements_dir = os.path.join(DELIVERY_DIR, "memo_elements")
+    return (
+        fetch_headers(os.path.join(elements_dir, "headings.txt")),
+        fetch_headers(os.path.join(elements_dir, "subheadings.txt")),
+    )
+
+
+@pytest.fixture
+def formatted(titles):
+    """
+    A fake Docs service holding the sample memo after it was formatted.
+    """
+    heading_titles, subheading_titles = titles
+    service = FakeDocsService(build_sample_memo(heading_titles, subheading_titles))
+    format_document(service, "memo", heading_titles, subheading_titles)
+    return service
+
+
+def test_format_document_api_calls(formatted):
+    # One read, one batch update for the formatting and one for the logo
+    assert formatted.calls == ["get", "batchUpdate", "batchUpdate"]
+
+
+def test_format_document_styles_titles(formatted, titles):
+    heading_titles, subheading_titles = titles
+
+    # Every styled range holds exactly its title, and every subheading ends its line
+    headings = [text for style, text, _ in formatted.paragraph_styles if style == "HEADING_1"]
+    subheadings = [
+        (text, next_char) for style, text, next_char in formatted.paragraph_styles if style == "HEADING_3"
+    ]
+    assert headings == heading_titles
+    assert [text for text, _ in subheadings] == subheading_titles
+    assert all(next_char == "\n" for _, next_char in subheadings)
+
+
+def test_format_document_font_covers_body(formatted):
+    # The font covers the whole body after the newlines were inserted
+    for start_index, end_index, body_end_index in formatted.text_styles:
+        assert (start_index, end_index) == (1, body_end_index)
+
+
+def test_format_document_logo_and_page_breaks(formatted, titles):
+    heading_titles, _ = titles
+
+    # The logo opens the document and the Executive Summary ends with a page break
+    assert formatted.text.startswith("\ufffc" + heading_titles[0])
+    assert "\fII. Investment Rationale" in formatted.text
+
+
+def test_format_document_ignores_titles_in_body(titles):
+    heading_titles, subheading_titles = titles
+    memo_text = (
+        "I. Executive Summary\n"
+        "The Summary of the risk matrix is in the Appendices.\n"
+        "Request: An offer for the target.\n"
+        "Appendices\n"
+    )
+    service = FakeDocsService(memo_text)
+    format_document(service, "memo", heading_titles, subheading_titles)
+
+    # Titles mentioned in body text are not styled
+    assert [(style, text) for style, text, _ in service.paragraph_styles] == [
+        ("HEADING_1", "Executive Summary"),
+        ("HEADING_1", "Appendices"),
+        ("HEADING_3", "Request:"),
+    ]